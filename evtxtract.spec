@@ -16,10 +16,8 @@ a = Analysis(
      cipher=None)
 
 a.binaries = a.binaries - TOC([
- ('sqlite3.dll', None, None),
  ('tcl85.dll', None, None),
  ('tk85.dll', None, None),
- ('_sqlite3', None, None),
  ('_ssl', None, None),
  ('_tkinter', None, None)])
 
@@ -1,9 +1,15 @@
+import struct
 import logging
-import collections
+import sqlite3
+import tempfile
+import itertools
+
+import six
 
 import evtxtract.utils
 import evtxtract.carvers
 import evtxtract.templates
+import evtxtract.checkpoint
 
 
 logger = logging.getLogger(__name__)
@@ -12,95 +18,542 @@ VALUE = 1
 
 
 class CompleteRecord(object):
-    __slots__ = ('offset', 'eid', 'xml')
+    __slots__ = ('offset', 'eid', '_xml', 'template', 'substitutions', 'num', 'timestamp', 'chunk_offset')
 
-    def __init__(self, offset, eid, xml):
+    def __init__(self, offset, eid, xml=None, template=None, substitutions=None,
+                 num=None, timestamp=None, chunk_offset=None):
+        '''
+        Args:
+          offset (int): the offset of the record within the input.
+          eid (int): the event ID of the record.
+          xml (str): the XML of the record, or None to render it from the template and substitutions.
+          template (evtxtract.templates.Template): the template that completed the record, if it was carved.
+          substitutions (evtxtract.carvers.Substitutions): the substitutions of the record, if it was carved.
+          num (int): the record number.
+          timestamp (datetime.datetime): the time the record was written, if it's valid.
+          chunk_offset (int): the offset of the chunk within the input, if the record was recovered from a valid chunk.
+        '''
         super(CompleteRecord, self).__init__()
         self.offset = offset
         self.eid = eid
-        self.xml = xml
+        self._xml = xml
+        self.template = template
+        self.substitutions = substitutions
+        self.num = num
+        self.timestamp = timestamp
+        self.chunk_offset = chunk_offset
+
+    @property
+    def xml(self):
+        '''
+        The XML of the record, rendered when it's first accessed.
+
+        Raises:
+          evtxtract.carvers.ParseError: if a substitution value can't be decoded.
+        '''
+        if self._xml is None:
+            self._xml = self.template.insert_substitutions(self.substitutions)
+        return self._xml
 
 
 class IncompleteRecord(object):
-    __slots__ = ('offset', 'eid', 'substitutions')
+    __slots__ = ('offset', 'eid', 'substitutions', 'num', 'timestamp')
 
-    def __init__(self, offset, eid, substitutions):
+    def __init__(self, offset, eid, substitutions, num=None, timestamp=None):
+        '''
+        Args:
+          offset (int): the offset of the record within the input.
+          eid (int): the event ID of the record.
+          substitutions (evtxtract.carvers.Substitutions): the substitutions of the record.
+          num (int): the record number.
+          timestamp (datetime.datetime): the time the record was written.
+        '''
         super(IncompleteRecord, self).__init__()
         self.offset = offset
         self.eid = eid
         self.substitutions = substitutions
+        self.num = num
+        self.timestamp = timestamp
+
+
+# the number of distinct records for which the duplicate filter is sized.
+DEDUP_CAPACITY = 0x1000000
+# the number of new digests collected before they're inserted into the exact index.
+DEDUP_BATCH_SIZE = 0x1000
+
+
+class DuplicateFilter(object):
+    '''
+    Recognizes copies of records that were already recovered, by the digest of their content.
+
+    Digests are checked against a Bloom filter in a fixed amount of memory, so a new record is recognized quickly.
+    When the Bloom filter reports that a digest may have been seen, it's checked against an exact index
+      in a temporary database on disk, so a record is never suppressed due to a false positive.
+    '''
+
+    def __init__(self, report=None, capacity=DEDUP_CAPACITY):
+        '''
+        Args:
+          report (evtxtract.carvers.ScanReport): if provided, the suppressed records are counted in this report.
+          capacity (int): the expected number of distinct records.
+        '''
+        super(DuplicateFilter, self).__init__()
+        self.report = report
+        self._bloom = evtxtract.utils.BloomFilter(capacity)
+        # an empty path opens a private database in a temporary file,
+        #  which is deleted when the filter is garbage collected.
+        self._db = sqlite3.connect('')
+        self._db.execute('CREATE TABLE digests (digest BLOB PRIMARY KEY)')
+        # the digests not yet inserted into the database.
+        self._pending = set()
+
+    def _insert(self):
+        self._db.executemany('INSERT INTO digests VALUES (?)', [(sqlite3.Binary(d), ) for d in self._pending])
+        self._db.commit()
+        self._pending = set()
+
+    def _add(self, digest):
+        self._pending.add(digest)
+        if len(self._pending) >= DEDUP_BATCH_SIZE:
+            self._insert()
+
+    def is_duplicate(self, digest):
+        '''
+        Check whether a record with the given digest was seen already, and note that it's been seen.
+
+        Args:
+          digest (bytes): the digest of the record, from `evtxtract.carvers.get_record_digest`.
+
+        Returns:
+          bool: True if the record is a copy of one that was seen already.
+        '''
+        if not self._bloom.add(digest):
+            self._add(digest)
+            return False
+
+        if digest in self._pending:
+            duplicate = True
+        else:
+            cursor = self._db.execute('SELECT 1 FROM digests WHERE digest = ?', (sqlite3.Binary(digest), ))
+            duplicate = cursor.fetchone() is not None
+
+        if not duplicate:
+            # a false positive of the Bloom filter.
+            self._add(digest)
+            return False
+
+        if self.report is not None:
+            self.report.duplicate_records += 1
+        return True
+
+
+def _extract_chunk(buf, offset, templates, decoded, base=0, duplicates=None):
+    '''
+    Recover the records and templates from the valid EVTX chunk at the given offset.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): the offset of the chunk within `buf`.
+      templates (evtxtract.templates.TemplateIndex): index to which the templates of the chunk are added.
+      decoded (evtxtract.utils.IntervalIndex): index to which the regions of the
+        recovered records are added.
+      base (int): the offset of `buf` within the input, used to report record offsets.
+      duplicates (DuplicateFilter): if provided, copies of records that were already recovered are skipped.
+
+    Returns:
+      iterable[CompleteRecord]: the records recovered from the chunk.
+    '''
+    for record, template in evtxtract.carvers.extract_chunk(buf, offset):
+        if template is not None:
+            templates.add(template)
+
+        size = struct.unpack_from('<I', buf, record.offset + 4)[0]
+        decoded.add(base + record.offset, base + record.offset + size)
+        if duplicates is not None and duplicates.is_duplicate(evtxtract.carvers.get_record_digest(buf, record.offset)):
+            continue
+        yield CompleteRecord(base + record.offset, record.eid, record.xml,
+                             num=record.num, timestamp=record.timestamp, chunk_offset=base + offset)
+
+
+def _extract_record(buf, offset, templates, base=0, duplicates=None):
+    '''
+    Reconstruct the EVTX record at the given offset using the given templates.
 
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): the offset of the record within `buf`.
+      templates (evtxtract.templates.TemplateIndex): the templates collected from the valid chunks.
+      base (int): the offset of `buf` within the input, used to report the record offset.
+      duplicates (DuplicateFilter): if provided, a copy of a record that was already recovered is skipped.
 
-def extract(buf):
+    Returns:
+      union[CompleteRecord, IncompleteRecord, None]: the reconstructed record, or None
+        if the record can't be parsed, or is a copy.
+    '''
+    record_offset = base + offset
+    try:
+        record = evtxtract.carvers.extract_record(buf, offset)
+    except evtxtract.carvers.ParseError as e:
+        logger.info('parse error for record at offset: 0x%x: %s', record_offset, str(e))
+        return None
+    except ValueError as e:
+        logger.info('timestamp parse error for record at offset: 0x%x: %s', record_offset, str(e))
+        return None
+    except Exception as e:
+        logger.info('unknown parse error for record at offset: 0x%x: %s', record_offset, str(e))
+        return None
+
+    if len(record.substitutions) < 4:
+        logger.info('too few substitutions for record at offset: 0x%x', record_offset)
+        return None
+
+    # copies are skipped before they're matched against the templates or rendered.
+    if duplicates is not None and duplicates.is_duplicate(
+            evtxtract.carvers.get_record_digest(buf, offset, record.substitutions)):
+        logger.debug('duplicate record at offset: 0x%x', record_offset)
+        return None
+
+    # the substitution values are decoded on demand: the EID here, and the others when the record is rendered.
+    try:
+        # we just know that the EID is substitution index 3
+        eid = record.substitutions[3][VALUE]
+
+        matching_templates = templates.match(eid, record.substitutions)
+
+        if len(matching_templates) == 0:
+            logger.info('no matching templates for record at offset: 0x%x', record_offset)
+            return IncompleteRecord(record_offset, eid, record.substitutions,
+                                    num=record.num, timestamp=record.timestamp)
+
+        if len(matching_templates) > 1:
+            logger.info('too many templates for record at offset: 0x%x', record_offset)
+            return IncompleteRecord(record_offset, eid, record.substitutions,
+                                    num=record.num, timestamp=record.timestamp)
+
+        template = matching_templates[0]
+    except evtxtract.carvers.ParseError as e:
+        logger.info('parse error for record at offset: 0x%x: %s', record_offset, str(e))
+        return None
+    except Exception as e:
+        logger.info('unknown parse error for record at offset: 0x%x: %s', record_offset, str(e))
+        return None
+
+    # the XML is rendered on demand, since some outputs don't need it.
+    return CompleteRecord(record_offset, eid, template=template, substitutions=record.substitutions,
+                          num=record.num, timestamp=record.timestamp)
+
+
+def extract(buf, jobs=1, report=None, templates=None, dedup=False):
     '''
     Do the EVTXtract algorithm and reconstruct EVTX records from the given data.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
+      jobs (int): the number of processes with which to scan the data.
+      report (evtxtract.carvers.ScanReport): if provided, statistics about the scan are added to this report.
+      templates (evtxtract.templates.TemplateIndex): if provided, templates known before the extraction,
+        such as from a template library. the templates recovered from the data are added to it.
+      dedup (bool): skip copies of records that were already recovered, with the same record number,
+        timestamp, and substitutions. the copies are counted in the report.
 
     Returns:
       iterable[union[CompleteRecord, IncompleteRecord]]: a generator of either
         CompleteRecord or IncompleteRecord. You'll have to type-switch of these
         classes to decide out how to handle them.
     '''
-    # this does a full scan of the file (#1)
-    chunks = set(evtxtract.carvers.find_evtx_chunks(buf))
+    if templates is None:
+        templates = evtxtract.templates.TemplateIndex()
 
-    valid_record_offsets = set([])
-    for chunk in chunks:
-        for record in evtxtract.carvers.extract_chunk_records(buf, chunk):
-            valid_record_offsets.add(record.offset)
-            yield CompleteRecord(record.offset, record.eid, record.xml)
+    # the regions of the file covered by records recovered from valid chunks.
+    # the records of a fully decoded chunk coalesce into a single interval,
+    #  which the scan then skips over.
+    decoded = evtxtract.utils.IntervalIndex()
 
-    # map from eid to dictionary mapping from templateid to template
-    templates = collections.defaultdict(dict)
-    for chunk in chunks:
-        for template in evtxtract.carvers.extract_chunk_templates(buf, chunk):
-            templates[template.eid][template.get_id()] = template
+    duplicates = DuplicateFilter(report) if dedup else None
 
-    # this does a full scan of the file (#2).
+    # this does the only full scan of the file.
+    # there may be millions of record candidates,
+    #  so keep their offsets in a compact array until the templates are collected.
+    record_offsets = evtxtract.utils.offset_array()
+
+    for kind, offset in evtxtract.carvers.find_evtx_structures(buf, jobs=jobs, skip=decoded, report=report):
+        if kind == evtxtract.carvers.EVTX_CHUNK:
+            for record in _extract_chunk(buf, offset, templates, decoded, duplicates=duplicates):
+                yield record
+        else:
+            record_offsets.append(offset)
+
+    # this revisits the record candidates found during the scan.
     # needs to be distinct because we must have collected all the templates
     # first.
-    for record_offset in evtxtract.carvers.find_evtx_records(buf):
-        if record_offset in valid_record_offsets:
-            continue
+    for record_offset in record_offsets:
+        record = _extract_record(buf, record_offset, templates, duplicates=duplicates)
+        if record is not None:
+            yield record
+
+
+def _map_offsets(mm, offsets):
+    '''
+    Map each of the given offsets into a window of the file, mapping the windows in order.
+    The window is unmapped once the next offset is requested, so don't hold on to it.
+
+    Args:
+      mm (evtxtract.utils.WindowedMmap): the file.
+      offsets (sequence[int]): offsets within the file, in ascending order.
+
+    Returns:
+      iterable[tuple[buffer, int, int]]: tuples (buf, offset, base), where `offset` is relative
+        to the window `buf`, and `base` is the offset of the window within the file.
+    '''
+    if not offsets:
+        return
+
+    i = 0
+    for base, buf, scan_end in mm.windows(offsets[0]):
+        while i < len(offsets) and offsets[i] < base + scan_end:
+            yield buf, offsets[i] - base, base
+            i += 1
 
+        if i == len(offsets):
+            break
+
+
+# number of bytes of record candidates held in memory before spilling to disk.
+SPILL_MEMORY_SIZE = 0x4000000
+
+
+def _spill_record(spill, buf, offset):
+    # the size was validated by the scan, and the record lies within `buf`.
+    size = struct.unpack_from('<I', buf, offset + 4)[0]
+    spill.write(buf[offset:offset + size])
+
+
+def _read_spilled_record(spill):
+    header = spill.read(8)
+    size = struct.unpack_from('<I', header, 4)[0]
+    return header + spill.read(size - 8)
+
+
+def _find_structures_windowed(mm, start, pool, skip, report=None):
+    '''
+    Scan the windows of the given file for EVTX structures, beginning at `start`.
+    With a pool of workers, the shards of all the windows are fed to the one pool,
+      so the workers run ahead of the window that the caller is processing.
+
+    Args:
+      mm (evtxtract.utils.WindowedMmap): the file.
+      start (int): the offset from which to scan.
+      pool (evtxtract.carvers.ScanPool): the pool that scans the shards of the file, by its path.
+      skip (evtxtract.utils.IntervalIndex): regions of the file that should not be scanned for records.
+      report (evtxtract.carvers.ScanReport): if provided, statistics about the scan are added to this report.
+
+    Returns:
+      iterable[tuple[int, buffer, int, iterable[tuple[int, int]]]]: for each window, tuples
+        (base, buf, scan_end, structures), as generated by `WindowedMmap.windows`, where `structures`
+        generates the (kind, offset) of the structures beginning in the window, relative to `buf`,
+        and must be consumed before the next window.
+    '''
+    if start >= len(mm):
+        # such as when resuming after the scan completed.
+        return
+
+    if pool.jobs <= 1:
+        for base, buf, scan_end in mm.windows(start):
+            # the first window may have been partly scanned before a checkpoint.
+            structures = evtxtract.carvers.find_evtx_structures(buf, max(start - base, 0), scan_end, skip=skip,
+                                                                base=base, report=report)
+            yield base, buf, scan_end, structures
+        return
+
+    # size the shards from the whole file, but don't let them span windows,
+    #  so the results of each window are found in the window.
+    shard_size = min(evtxtract.carvers.get_shard_size(len(mm) - start, pool.jobs), mm.window_size)
+    shards = []
+    counts = []
+    for base in range(start - (start % mm.window_size), len(mm), mm.window_size):
+        window_end = min(base + mm.window_size, len(mm))
+        window_shards = [(shard_start, min(shard_start + shard_size, window_end))
+                         for shard_start in range(max(base, start), window_end, shard_size)]
+        shards.extend(window_shards)
+        counts.append(len(window_shards))
+
+    results = pool.scan(shards)
+    for (base, buf, scan_end), count in six.moves.zip(mm.windows(start), counts):
+        # the offsets from the workers are relative to the file, and so are the regions in `skip`.
+        structures = evtxtract.carvers.merge_shards(itertools.islice(results, count), skip=skip, report=report)
+        yield base, buf, scan_end, ((kind, offset - base) for kind, offset in structures)
+
+
+def extract_windowed(mm, jobs=1, report=None, checkpoint=None, templates=None, dedup=False, pool=None):
+    '''
+    Do the EVTXtract algorithm and reconstruct EVTX records from the given file,
+      mapping only one window of the file at a time.
+
+    The file is read once. As in `extract_stream`, the raw bytes of each record candidate
+      are spilled as they're found, and resolved once all the templates are collected.
+
+    Args:
+      mm (evtxtract.utils.WindowedMmap): the file from which to extract structures.
+        its windows must overlap by at least `evtxtract.carvers.MAX_STRUCTURE_SIZE`.
+      jobs (int): the number of processes with which to scan the file, if no pool is provided.
+      report (evtxtract.carvers.ScanReport): if provided, statistics about the scan are added to this report.
+      templates (evtxtract.templates.TemplateIndex): if provided, templates known before the extraction,
+        such as from a template library. the templates recovered from the data are added to it.
+      checkpoint (evtxtract.checkpoint.Checkpoint): if provided, the progress is saved to this checkpoint
+        after each window and each record, and the extraction resumes from its progress.
+        the record candidates are spilled next to its state file.
+      dedup (bool): skip copies of records that were already recovered, with the same record number,
+        timestamp, and substitutions. the copies are counted in the report.
+      pool (evtxtract.carvers.ScanPool): if provided, the pool of processes that scans the file, by its path.
+        otherwise, a pool of `jobs` processes is created for the extraction.
+
+    Returns:
+      iterable[union[CompleteRecord, IncompleteRecord]]: a generator of either
+        CompleteRecord or IncompleteRecord. You'll have to type-switch of these
+        classes to decide out how to handle them.
+    '''
+    if checkpoint is None:
+        checkpoint = evtxtract.checkpoint.Checkpoint()
+
+    if templates is None:
+        templates = evtxtract.templates.TemplateIndex()
+
+    # when resuming, recover the templates from the chunks that were already scanned.
+    for buf, offset, base in _map_offsets(mm, checkpoint.chunk_offsets):
+        for template in evtxtract.carvers.extract_chunk_templates(buf, offset):
+            templates.add(template)
+
+    # the regions of the file covered by records recovered from valid chunks.
+    decoded = checkpoint.decoded
+
+    # the offsets of the record candidates within the file, in ascending order,
+    #  and in the same order as their data in the spill.
+    record_offsets = checkpoint.record_offsets
+
+    # the digests of the records aren't saved in the checkpoint,
+    #  so when resuming, copies of the records emitted before the checkpoint aren't recognized.
+    duplicates = DuplicateFilter(report) if dedup else None
+
+    owns_pool = pool is None
+    if owns_pool:
+        pool = evtxtract.carvers.ScanPool(mm.filename, jobs)
+
+    spill = checkpoint.open_spill(SPILL_MEMORY_SIZE)
+    try:
         try:
-            record = evtxtract.carvers.extract_record(buf, record_offset)
-        except evtxtract.carvers.ParseError as e:
-            logger.info('parse error for record at offset: 0x%x: %s', record_offset, str(e))
-            continue
-        except ValueError as e:
-            logger.info('timestamp parse error for record at offset: 0x%x: %s', record_offset, str(e))
-            continue
-        except Exception as e:
-            logger.info('unknown parse error for record at offset: 0x%x: %s', record_offset, str(e))
-            continue
+            for base, buf, scan_end, structures in _find_structures_windowed(mm, checkpoint.position, pool,
+                                                                             decoded, report=report):
+                for kind, offset in structures:
+                    if kind == evtxtract.carvers.EVTX_CHUNK:
+                        for record in _extract_chunk(buf, offset, templates, decoded, base=base,
+                                                     duplicates=duplicates):
+                            yield record
+                        checkpoint.chunk_offsets.append(base + offset)
+                    else:
+                        _spill_record(spill, buf, offset)
+                        record_offsets.append(base + offset)
 
-        if len(record.substitutions) < 4:
-            logger.info('too few substitutions for record at offset: 0x%x', record_offset)
-            continue
+                checkpoint.position = base + scan_end
+                checkpoint.spill_size = spill.tell()
+                checkpoint.maybe_save()
+        finally:
+            if owns_pool:
+                pool.close()
 
-        # we just know that the EID is substitution index 3
-        eid = record.substitutions[3][VALUE]
+        # revisit the record candidates, reading them back from the spill.
+        spill.seek(checkpoint.spill_position)
+        for record_offset in record_offsets[checkpoint.resolved:]:
+            record_buf = _read_spilled_record(spill)
+            record = _extract_record(record_buf, 0, templates, base=record_offset, duplicates=duplicates)
+            if record is not None:
+                yield record
 
-        matching_templates = set([])
-        for template in templates.get(eid, {}).values():
-            if template.match_substitutions(record.substitutions):
-                matching_templates.add(template)
+            checkpoint.resolved += 1
+            checkpoint.spill_position = spill.tell()
+            checkpoint.maybe_save()
+    finally:
+        spill.close()
 
-        if len(matching_templates) == 0:
-            logger.info('no matching templates for record at offset: 0x%x', record_offset)
-            yield IncompleteRecord(record_offset, eid, record.substitutions)
-            continue
 
-        if len(matching_templates) > 1:
-            logger.info('too many templates for record at offset: 0x%x', record_offset)
-            yield IncompleteRecord(record_offset, eid, record.substitutions)
-            continue
+# number of bytes read from a stream at a time.
+STREAM_READ_SIZE = evtxtract.carvers.SCAN_BLOCK_SIZE
+
+
+def extract_stream(f, report=None, templates=None, dedup=False):
+    '''
+    Do the EVTXtract algorithm and reconstruct EVTX records from the given stream,
+      which need not be seekable, such as stdin, a pipe, or a decompressing reader.
+
+    The stream is read once, into a sliding window that keeps enough trailing data
+      (`evtxtract.carvers.MAX_STRUCTURE_SIZE`) that any structure beginning in the
+      scanned region can be validated and parsed.
+    The chunks are decoded as they arrive. Since orphaned records can only be
+      reconstructed after all the templates are collected, the raw bytes of each record
+      candidate are spilled to a temporary file, and resolved at the end of the stream.
+
+    Args:
+      f (file): the binary stream from which to extract structures.
+      report (evtxtract.carvers.ScanReport): if provided, statistics about the scan are added to this report.
+      templates (evtxtract.templates.TemplateIndex): if provided, templates known before the extraction,
+        such as from a template library. the templates recovered from the data are added to it.
+      dedup (bool): skip copies of records that were already recovered, with the same record number,
+        timestamp, and substitutions. the copies are counted in the report.
+
+    Returns:
+      iterable[union[CompleteRecord, IncompleteRecord]]: a generator of either
+        CompleteRecord or IncompleteRecord. You'll have to type-switch of these
+        classes to decide out how to handle them.
+    '''
+    if templates is None:
+        templates = evtxtract.templates.TemplateIndex()
+
+    # the regions of the stream covered by records recovered from valid chunks.
+    decoded = evtxtract.utils.IntervalIndex()
+
+    # the offsets of the record candidates within the stream,
+    #  in the same order as their data in `spill`.
+    record_offsets = evtxtract.utils.offset_array()
+
+    duplicates = DuplicateFilter(report) if dedup else None
+
+    spill = tempfile.SpooledTemporaryFile(max_size=SPILL_MEMORY_SIZE)
+    try:
+        # the offset of `buf` within the stream.
+        base = 0
+        buf = b''
+        while True:
+            data = f.read(STREAM_READ_SIZE)
+            buf += data
+
+            if data:
+                # leave enough data in the window to validate anything that begins before the end
+                #  of the scanned region. it will be scanned along with the next read.
+                scan_end = len(buf) - evtxtract.carvers.MAX_STRUCTURE_SIZE
+            else:
+                scan_end = len(buf)
+
+            if scan_end > 0:
+                for kind, offset in evtxtract.carvers.find_evtx_structures(buf, 0, scan_end, skip=decoded,
+                                                                           base=base, report=report):
+                    if kind == evtxtract.carvers.EVTX_CHUNK:
+                        for record in _extract_chunk(buf, offset, templates, decoded, base=base,
+                                                     duplicates=duplicates):
+                            yield record
+                    else:
+                        _spill_record(spill, buf, offset)
+                        record_offsets.append(base + offset)
 
-        template = list(matching_templates)[0]
+                buf = buf[scan_end:]
+                base += scan_end
 
-        record_xml = template.insert_substitutions(record.substitutions)
+            if not data:
+                break
 
-        yield CompleteRecord(record_offset, eid, record_xml)
+        spill.seek(0)
+        for record_offset in record_offsets:
+            record_buf = _read_spilled_record(spill)
+            record = _extract_record(record_buf, 0, templates, base=record_offset, duplicates=duplicates)
+            if record is not None:
+                yield record
+    finally:
+        spill.close()
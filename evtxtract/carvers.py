@@ -1,8 +1,12 @@
-import re
+import os
+import mmap
+import zlib
 import struct
+import hashlib
 import logging
 import binascii
 import datetime
+import multiprocessing
 import xml.sax.saxutils
 from collections import namedtuple
 
@@ -12,6 +16,11 @@ import Evtx.Views
 
 import evtxtract.templates
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -20,17 +29,211 @@ logger = logging.getLogger(__name__)
 EVTX_HEADER_MAGIC = b"ElfChnk"
 EVTX_RECORD_MAGIC = b"\x2a\x2a\x00\x00"
 CHUNK_SIZE = 0x10000
+# the records begin after the chunk header, and its string and template tables.
+CHUNK_DATA_OFFSET = 0x200
 MIN_CHUNK_HEADER_SIZE = 0x80
 MAX_CHUNK_HEADER_SIZE = 0x200
+MIN_RECORD_SIZE = 0x30
+MAX_RECORD_SIZE = 0x10000
+# a chunk or record that begins at some offset may extend this far past it.
+MAX_STRUCTURE_SIZE = max(CHUNK_SIZE, MAX_RECORD_SIZE)
+
+# number of bytes swept for all the signatures before moving on to the next region.
+# this should be small enough that the region stays resident in the page cache
+#  while we search it once for each signature.
+SCAN_BLOCK_SIZE = 0x1000000
+
+# the granularity at which empty regions are recognized and skipped.
+PAGE_SIZE = 0x1000
+# a signature may begin this many bytes before the end of an empty page, and run into the next page.
+SIGNATURE_SLACK = max(len(EVTX_HEADER_MAGIC), len(EVTX_RECORD_MAGIC)) - 1
 
 
 class ParseError(RuntimeError): pass
 
 
+def find_magic(buf, magic, start=0, end=None):
+    """
+    Generates the offsets of the given signature that begin within [start, end).
+
+    Args:
+      buf (buffer): the binary data to search.
+      magic (bytes): the signature to search for.
+      start (int): the offset at which to begin searching.
+      end (int): matches must begin before this offset. default: the end of the buffer.
+
+    Returns:
+      iterable[int]: generator of offsets of the signature.
+    """
+    if end is None:
+        end = len(buf)
+    # allow a match that begins just before `end` to run past it.
+    limit = min(end + len(magic) - 1, len(buf))
+
+    offset = start
+    while True:
+        offset = buf.find(magic, offset, limit)
+        if offset == -1:
+            break
+
+        yield offset
+
+        offset += 1
+
+
+def find_magic_batch(buf, magic, start=0, end=None):
+    """
+    Collect the offsets of the given signature that begin within [start, end).
+    When NumPy is installed, the range is searched using array operations,
+      which avoids a round trip through the interpreter for each match.
+
+    Args:
+      buf (buffer): the binary data to search.
+      magic (bytes): the signature to search for.
+      start (int): the offset at which to begin searching.
+      end (int): matches must begin before this offset. default: the end of the buffer.
+
+    Returns:
+      list[int]: the offsets of the signature, in ascending order.
+    """
+    if numpy is None:
+        return list(find_magic(buf, magic, start, end))
+
+    if end is None:
+        end = len(buf)
+    limit = min(end + len(magic) - 1, len(buf))
+    if limit - start < len(magic):
+        return []
+
+    data = numpy.frombuffer(buf, dtype=numpy.uint8, count=limit - start, offset=start)
+    hits = numpy.flatnonzero(data[:len(data) - len(magic) + 1] == six.indexbytes(magic, 0))
+    for i in range(1, len(magic)):
+        hits = hits[data[hits + i] == six.indexbytes(magic, i)]
+
+    return (hits + start).tolist()
+
+
+class ScanReport(object):
+    """
+    Statistics collected while scanning, so the caller can report on the work that was avoided.
+    """
+
+    def __init__(self):
+        super(ScanReport, self).__init__()
+        # the number of bytes in uniform pages that were not searched for signatures.
+        self.uniform_bytes = 0
+        # the number of copies of records that were suppressed.
+        self.duplicate_records = 0
+
+
+def _find_uniform_page_mask(buf, first_page, last_page):
+    """
+    Classify each page in [first_page, last_page) as uniform or not.
+
+    Args:
+      buf (buffer): the binary data to classify.
+      first_page (int): the index of the first page to classify.
+      last_page (int): the index after the last page to classify.
+
+    Returns:
+      list[bool]: for each page, True if it consists of a single repeated byte value.
+    """
+    if numpy is None:
+        mask = []
+        for page in range(first_page, last_page):
+            data = buf[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+            mask.append(data.count(data[:1]) == PAGE_SIZE)
+        return mask
+
+    words = numpy.frombuffer(buf, dtype=numpy.uint64,
+                             count=(last_page - first_page) * PAGE_SIZE // 8,
+                             offset=first_page * PAGE_SIZE).reshape(-1, PAGE_SIZE // 8)
+    first_words = words[:, 0]
+    # the page is uniform if every word matches the first, and the first word is a single repeated byte.
+    mask = (words == first_words[:, numpy.newaxis]).all(axis=1)
+    mask &= first_words == (first_words & 0xFF) * numpy.uint64(0x0101010101010101)
+    return mask.tolist()
+
+
+def find_uniform_pages(buf, start=0, end=None):
+    """
+    Find the runs of pages that consist of a single repeated byte value, such as zero-filled
+      or constant-fill pages, which can't contain any structures.
+    Only whole pages, aligned to `PAGE_SIZE` relative to the start of the buffer, are considered.
+
+    Args:
+      buf (buffer): the binary data to classify.
+      start (int): the offset at which to begin classifying.
+      end (int): the offset at which to stop classifying. default: the end of the buffer.
+
+    Returns:
+      list[tuple[int, int]]: the ranges [start, end) of runs of uniform pages, in ascending order.
+    """
+    if end is None:
+        end = len(buf)
+
+    first_page = -(-start // PAGE_SIZE)
+    last_page = end // PAGE_SIZE
+
+    runs = []
+    run_start = None
+    for block_page in range(first_page, last_page, SCAN_BLOCK_SIZE // PAGE_SIZE):
+        block_end_page = min(block_page + SCAN_BLOCK_SIZE // PAGE_SIZE, last_page)
+        mask = _find_uniform_page_mask(buf, block_page, block_end_page)
+        for page, is_uniform in enumerate(mask, block_page):
+            if is_uniform and run_start is None:
+                run_start = page
+            elif not is_uniform and run_start is not None:
+                runs.append((run_start * PAGE_SIZE, page * PAGE_SIZE))
+                run_start = None
+
+    if run_start is not None:
+        runs.append((run_start * PAGE_SIZE, last_page * PAGE_SIZE))
+
+    return runs
+
+
+def find_scan_ranges(buf, start=0, end=None, report=None):
+    """
+    Split the given range into the ranges in which a signature may begin,
+      leaving out the runs of uniform pages.
+
+    Args:
+      buf (buffer): the binary data to scan.
+      start (int): the offset at which to begin scanning.
+      end (int): signatures must begin before this offset. default: the end of the buffer.
+      report (ScanReport): if provided, the number of bytes left out is added to this report.
+
+    Returns:
+      list[tuple[int, int]]: the ranges [start, end) that should be searched, in ascending order.
+    """
+    if end is None:
+        end = len(buf)
+
+    ranges = []
+    range_start = start
+    for run_start, run_end in find_uniform_pages(buf, start, end):
+        if range_start < run_start:
+            ranges.append((range_start, run_start))
+        # the last few bytes of the run may hold the beginning of a signature
+        #  that continues into the next page.
+        range_start = run_end - SIGNATURE_SLACK
+        if report is not None:
+            report.uniform_bytes += range_start - run_start
+
+    if range_start < end:
+        ranges.append((range_start, end))
+
+    return ranges
+
+
 def is_chunk_header(buf, offset):
     """
     Return True if the offset appears to be an EVTX Chunk header.
-    Implementation note: Simply checks the magic header and size field for reasonable values.
+    Implementation note: checks the cheap things first (bounds, magic, and size fields),
+      and then computes the header and data checksums directly over the buffer.
+      No python-evtx structures are constructed, since most candidates in
+      slack space and swap files are stale copies that fail the checksums.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
@@ -39,60 +242,72 @@ def is_chunk_header(buf, offset):
     Returns:
       bool: if the offset appears to be an EVTX chunk header.
     """
-    if len(buf) < offset + 0x2C:
-        # our accesses below will overflow
+    if len(buf) < offset + CHUNK_SIZE:
+        # the chunk overruns the buffer end
         return False
 
     magic = struct.unpack_from("<7s", buf, offset)[0]
     if magic != EVTX_HEADER_MAGIC:
         return False
 
-    size = struct.unpack_from("<I", buf, offset + 0x28)[0]
+    size, next_record_offset, data_checksum = struct.unpack_from("<I4xII", buf, offset + 0x28)
     if not (MIN_CHUNK_HEADER_SIZE <= size <= MAX_CHUNK_HEADER_SIZE):
         return False
 
-    if len(buf) <= offset + size:
-        # the chunk overruns the buffer end
+    if not (CHUNK_DATA_OFFSET <= next_record_offset <= CHUNK_SIZE):
+        # the record data overruns the chunk
         return False
 
-    try:
-        chunk = Evtx.Evtx.ChunkHeader(buf, offset)
-    except:
-        logger.debug('failed to parse chunk header', exc_info=True)
-        return False
-
-    if len(buf) < offset + CHUNK_SIZE:
-        return False
+    header_checksum = struct.unpack_from("<I", buf, offset + 0x7C)[0]
 
-    if chunk.calculate_header_checksum() != chunk.header_checksum():
-        return False
-
-    if chunk.calculate_data_checksum() != chunk.data_checksum():
-        return False
+    if six.PY2:
+        # python 2.7's mmap doesn't support memoryview, so checksum slices of the buffer.
+        view = buf
+    else:
+        view = memoryview(buf)
+    try:
+        # the header checksum covers the header fields and the string and template tables,
+        #  but not the checksum field itself.
+        checksum = zlib.crc32(view[offset:offset + 0x78])
+        checksum = zlib.crc32(view[offset + 0x80:offset + CHUNK_DATA_OFFSET], checksum)
+        if checksum & 0xFFFFFFFF != header_checksum:
+            return False
+
+        checksum = zlib.crc32(view[offset + CHUNK_DATA_OFFSET:offset + next_record_offset])
+        if checksum & 0xFFFFFFFF != data_checksum:
+            return False
+    finally:
+        if view is not buf:
+            # don't hold on to the buffer, or a memory map could not be closed.
+            view.release()
 
     return True
 
 
-def find_evtx_chunks(buf):
+def find_evtx_chunks(buf, start=0, end=None, jobs=1, report=None):
     """
     Scans the given data for valid EVTX chunk structures.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
+      start (int): the offset at which to begin scanning.
+      end (int): chunks must begin before this offset. default: the end of the buffer.
+      jobs (int): the number of processes with which to scan. see `scan_in_parallel`.
+      report (ScanReport): if provided, statistics about the scan are added to this report.
 
     Returns:
       iterable[int]: generator of offsets of chunks
     """
-    offset = 0
-    while True:
-        offset = buf.find(EVTX_HEADER_MAGIC, offset)
-        if offset == -1:
-            break
-
-        if is_chunk_header(buf, offset):
-            yield offset
+    if jobs > 1:
+        for kind, offset in scan_in_parallel(buf, start, end, jobs, report=report):
+            if kind == EVTX_CHUNK:
+                yield offset
+        return
 
-        offset += 1
+    for range_start, range_end in find_scan_ranges(buf, start, end, report=report):
+        for offset in find_magic(buf, EVTX_HEADER_MAGIC, range_start, range_end):
+            if is_chunk_header(buf, offset):
+                yield offset
 
 
 def is_record(buf, offset):
@@ -114,7 +329,7 @@ def is_record(buf, offset):
     if magic != 0x00002a2a:
         return False
 
-    if not (0x30 <= size <= 0x10000):
+    if not (MIN_RECORD_SIZE <= size <= MAX_RECORD_SIZE):
         return False
 
     if len(buf) < offset + size:
@@ -127,83 +342,350 @@ def is_record(buf, offset):
     return True
 
 
-def find_evtx_records(buf):
+def _unpack_dwords(data, offsets):
+    """
+    Gather the little-endian DWORDs at each of the given offsets.
+
+    Args:
+      data (numpy.ndarray): the binary data, as an array of uint8.
+      offsets (numpy.ndarray): the offsets of the DWORDs, as an array of int64.
+
+    Returns:
+      numpy.ndarray: the DWORD values, as an array of uint32.
+    """
+    indices = offsets[:, numpy.newaxis] + numpy.arange(4)
+    return data[indices].view(numpy.dtype('<u4')).ravel()
+
+
+def filter_records(buf, offsets):
+    """
+    Select the offsets that appear to be EVTX records, with the same checks as `is_record`.
+    When NumPy is installed, the whole batch of candidates is validated at once
+      using array operations over the buffer, rather than one at a time.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offsets (list[int]): the addresses of the potential records.
+
+    Returns:
+      list[int]: the offsets that appear to be records, in the given order.
+    """
+    if numpy is None or not offsets:
+        return [offset for offset in offsets if is_record(buf, offset)]
+
+    data = numpy.frombuffer(buf, dtype=numpy.uint8)
+    offsets = numpy.array(offsets, dtype=numpy.int64)
+
+    offsets = offsets[offsets + 8 <= len(data)]
+    magics = _unpack_dwords(data, offsets)
+    sizes = _unpack_dwords(data, offsets + 4).astype(numpy.int64)
+
+    valid = (magics == 0x00002a2a) & (sizes >= MIN_RECORD_SIZE) & (sizes <= MAX_RECORD_SIZE)
+    valid &= offsets + sizes <= len(data)
+    offsets = offsets[valid]
+    sizes = sizes[valid]
+
+    sizes2 = _unpack_dwords(data, offsets + sizes - 4)
+    return offsets[sizes2 == sizes].tolist()
+
+
+def find_evtx_records(buf, start=0, end=None, jobs=1, report=None):
     """
     Generates offsets of apparent EVTX records from the given buffer.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
+      start (int): the offset at which to begin scanning.
+      end (int): records must begin before this offset. default: the end of the buffer.
+      jobs (int): the number of processes with which to scan. see `scan_in_parallel`.
+      report (ScanReport): if provided, statistics about the scan are added to this report.
 
     Returns:
       iterable[int]: the offsets of EVTX records.
     """
-    offset = 0
-    while True:
-        offset = buf.find(EVTX_RECORD_MAGIC, offset)
-        if offset == -1:
-            break
+    if jobs > 1:
+        for kind, offset in scan_in_parallel(buf, start, end, jobs, report=report):
+            if kind == EVTX_RECORD:
+                yield offset
+        return
 
-        if is_record(buf, offset):
-            yield offset
+    if end is None:
+        end = len(buf)
 
-        offset += 1
+    for block_start in range(start, end, SCAN_BLOCK_SIZE):
+        block_end = min(block_start + SCAN_BLOCK_SIZE, end)
+        for range_start, range_end in find_scan_ranges(buf, block_start, block_end, report=report):
+            candidates = find_magic_batch(buf, EVTX_RECORD_MAGIC, range_start, range_end)
+            for offset in filter_records(buf, candidates):
+                yield offset
 
 
-RecoveredRecord = namedtuple('RecoveredRecord', ['offset', 'eid', 'xml'])
+# the kinds of structures generated by `find_evtx_structures`.
+EVTX_CHUNK = 0
+EVTX_RECORD = 1
 
 
-def extract_chunk_records(buf, offset):
+def find_evtx_structures(buf, start=0, end=None, jobs=1, skip=None, base=0, report=None):
     """
-    Generates EVTX records from the EVTX chunk at the given offset.
+    Scans the given data for valid EVTX chunks and records in a single sequential pass.
+    The data is swept in blocks of `SCAN_BLOCK_SIZE` bytes, and each block is
+      searched for all the signatures before moving on, so each page is read from
+      the underlying storage only once.
+
+    Runs of uniform pages, such as zero-filled pages, are skipped wholesale.
+    The chunks within a block are generated before the records within the block,
+      so a caller that decodes each chunk as it's generated can add the decoded
+      regions to `skip`, and the scan for records jumps straight over them.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
-      offset (int): offset to EVTX chunk
+      start (int): the offset at which to begin scanning.
+      end (int): structures must begin before this offset. default: the end of the buffer.
+      jobs (int): the number of processes with which to scan. see `scan_in_parallel`.
+      skip (evtxtract.utils.IntervalIndex): regions that should not be scanned for records.
+      base (int): the offset of `buf` within the input, when `buf` is a window onto a larger input.
+        the regions in `skip` are relative to the start of the input.
+      report (ScanReport): if provided, statistics about the scan are added to this report.
 
     Returns:
-      iterable[int]: the offsets of EVTX records.
+      iterable[tuple[int, int]]: generator of (kind, offset),
+        where kind is one of `EVTX_CHUNK` or `EVTX_RECORD`.
+        within each kind, the offsets are in ascending order.
     """
-    try:
-        chunk = Evtx.Evtx.ChunkHeader(buf, offset)
-    except:
-        raise ParseError('failed to parse chunk header')
+    if jobs > 1:
+        for kind, offset in scan_in_parallel(buf, start, end, jobs, skip=skip, base=base, report=report):
+            yield kind, offset
+        return
 
-    cache = {}
-    for record in chunk.records():
+    if end is None:
+        end = len(buf)
+
+    block_start = start
+    while block_start < end:
+        block_end = min(block_start + SCAN_BLOCK_SIZE, end)
+
+        ranges = find_scan_ranges(buf, block_start, block_end, report=report)
+
+        for range_start, range_end in ranges:
+            for offset in find_magic_batch(buf, EVTX_HEADER_MAGIC, range_start, range_end):
+                if is_chunk_header(buf, offset):
+                    yield EVTX_CHUNK, offset
+
+        if skip is not None:
+            ranges = [(gap_start - base, gap_end - base)
+                      for range_start, range_end in ranges
+                      for gap_start, gap_end in skip.gaps(base + range_start, base + range_end)]
+
+        for range_start, range_end in ranges:
+            candidates = find_magic_batch(buf, EVTX_RECORD_MAGIC, range_start, range_end)
+            for offset in filter_records(buf, candidates):
+                yield EVTX_RECORD, offset
+
+        block_start = block_end
+
+
+# a structure that begins within a shard may extend this far beyond the end of the shard,
+#  so a worker may read up to this many bytes past its shard while validating candidates.
+SHARD_OVERLAP = MAX_STRUCTURE_SIZE
+
+# don't bother splitting the buffer into shards smaller than this.
+MIN_SHARD_SIZE = SCAN_BLOCK_SIZE
+
+
+def get_shard_size(size, jobs):
+    """
+    Choose the size of the shards into which a scan of the given size is split.
+    There are a few shards per worker, so that a slow shard doesn't leave the others idle.
+    The shards are whole blocks, so the structures are generated in the same order as by a serial scan.
+
+    Args:
+      size (int): the number of bytes to scan.
+      jobs (int): the number of worker processes.
+
+    Returns:
+      int: the size of each shard.
+    """
+    shard_size = -(-size // (jobs * 4))
+    return max(MIN_SHARD_SIZE, -(-shard_size // SCAN_BLOCK_SIZE) * SCAN_BLOCK_SIZE)
+
+
+# the buffer, or path of the file, scanned by a worker process. see `ScanPool`.
+_shard_source = None
+
+
+def _init_shard_worker(source):
+    global _shard_source
+    _shard_source = source
+
+
+def _scan_source_shard(source, start, end):
+    report = ScanReport()
+    if not isinstance(source, six.string_types):
+        return list(find_evtx_structures(source, start, end, report=report)), report
+
+    with open(source, 'rb') as f:
+        # map just the shard. mappings must begin on an allocation boundary.
+        map_start = start - (start % mmap.ALLOCATIONGRANULARITY)
+        map_end = min(end + SHARD_OVERLAP, os.fstat(f.fileno()).st_size)
+        m = mmap.mmap(f.fileno(), map_end - map_start, access=mmap.ACCESS_READ, offset=map_start)
         try:
-            record_xml = Evtx.Views.evtx_record_xml_view(record, cache=cache)
-            eid = evtxtract.utils.get_eid(record_xml)
-            yield RecoveredRecord(record.offset(), eid, record_xml)
+            results = [(kind, map_start + offset)
+                       for kind, offset in find_evtx_structures(m, start - map_start, end - map_start, report=report)]
+        finally:
+            m.close()
+    return results, report
 
-        except UnicodeEncodeError:
-            logger.info("Unicode encoding issue processing record at 0x%X", record.offset())
-            continue
 
-        except UnicodeDecodeError:
-            logger.info("Unicode decoding issue processing record at 0x%X", record.offset())
-            continue
+def _scan_shard(shard):
+    start, end = shard
+    return _scan_source_shard(_shard_source, start, end)
 
-        except Evtx.Evtx.InvalidRecordException:
-            logger.info("EVTX parsing issue processing record at 0x%X", record.offset())
-            continue
 
-        except Exception as e:
-            logger.info("Unknown exception processing record at 0x%X", record.offset(), exc_info=True)
-            continue
+class ScanPool(object):
+    """
+    A pool of processes that scan shards of a buffer or file for EVTX structures.
+    Each shard is scanned by `find_evtx_structures`, which only reports structures that
+      begin within the shard, though it may read up to `SHARD_OVERLAP` bytes beyond its end
+      to validate them. Therefore, each structure is reported by exactly one shard.
+
+    The workers of a buffer (such as a memory map) inherit it via `fork()`, so nothing is copied.
+    On platforms without `fork()`, the shards of a buffer are scanned in this process.
+    The workers of a file map just the shard they scan, so a pool can be kept
+      for the whole file, regardless of how much of it the caller maps at once.
+
+    The pool is created when this is constructed, which forks on most platforms,
+      so create it before starting any threads.
+    With a single job, the shards are scanned in this process.
+    """
 
+    def __init__(self, source, jobs=1):
+        """
+        Args:
+          source (union[buffer, str]): the binary data, or the path to the file, to scan.
+          jobs (int): the number of worker processes.
+        """
+        super(ScanPool, self).__init__()
+        self.source = source
+        self.jobs = jobs
+        self._pool = None
+        if jobs <= 1:
+            return
+
+        if isinstance(source, six.string_types):
+            self._pool = multiprocessing.Pool(jobs, initializer=_init_shard_worker, initargs=(source,))
+            return
 
-def extract_chunk_templates(buf, offset):
+        try:
+            context = multiprocessing.get_context('fork')
+        except (AttributeError, ValueError):
+            # python 2.7 has no `get_context`, and some platforms have no `fork()`.
+            logger.warning('parallel scanning is not supported on this platform, using a single process')
+            self.jobs = 1
+            return
+        self._pool = context.Pool(jobs, initializer=_init_shard_worker, initargs=(source,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def scan(self, shards):
+        """
+        Scan the given shards.
+        The shards are handed to the workers as they become idle, so pass all the shards
+          of the scan at once, and consume the results as they're needed.
+
+        Args:
+          shards (iterable[tuple[int, int]]): the ranges [start, end) in which structures must begin.
+
+        Returns:
+          iterable[tuple[list[tuple[int, int]], ScanReport]]: for each shard, in order,
+            the (kind, offset) of the structures found in it, and the statistics of its scan.
+        """
+        if self._pool is None:
+            return (_scan_source_shard(self.source, start, end) for start, end in shards)
+        return self._pool.imap(_scan_shard, shards)
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+def merge_shards(results, skip=None, base=0, report=None):
     """
-    Generates EVTX record templates from the EVTX chunk at the given offset.
+    Merge the results of scanning shards with a `ScanPool`, in shard order.
+
+    Args:
+      results (iterable[tuple[list[tuple[int, int]], ScanReport]]): the results of `ScanPool.scan`.
+      skip (evtxtract.utils.IntervalIndex): regions in which records are dropped.
+      base (int): the offset of the scanned data within the input. the regions in `skip` are relative to the input.
+      report (ScanReport): if provided, the statistics from all the shards are added to this report.
+
+    Returns:
+      iterable[tuple[int, int]]: generator of (kind, offset), as by `find_evtx_structures`.
+    """
+    for structures, shard_report in results:
+        if report is not None:
+            report.uniform_bytes += shard_report.uniform_bytes
+        for kind, offset in structures:
+            # the workers can't see updates to `skip`, so filter their results here.
+            # a record is generated after any chunk that contains it, so `skip` is up to date.
+            if kind == EVTX_RECORD and skip is not None and base + offset in skip:
+                continue
+            yield kind, offset
+
+
+def scan_in_parallel(buf, start=0, end=None, jobs=1, skip=None, base=0, report=None):
+    """
+    Split the given range of the buffer into shards and scan them for EVTX structures
+      using a pool of processes. The results are generated in shard order,
+      so they are identical to those of a serial scan.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
-      offset (int): offset to EVTX chunk.
+      start (int): the offset at which to begin scanning.
+      end (int): structures must begin before this offset. default: the end of the buffer.
+      jobs (int): the number of worker processes.
+      skip (evtxtract.utils.IntervalIndex): regions in which records are dropped.
+      base (int): the offset of `buf` within the input. the regions in `skip` are relative to the input.
+      report (ScanReport): if provided, the statistics from all the shards are added to this report.
 
     Returns:
-      iterable[evtxtract.templates.Template]: a generator of the things you asked for.
+      iterable[tuple[int, int]]: generator of (kind, offset), as by `find_evtx_structures`.
     """
+    if end is None:
+        end = len(buf)
+
+    shard_size = get_shard_size(end - start, jobs)
+    shards = [(shard_start, min(shard_start + shard_size, end)) for shard_start in range(start, end, shard_size)]
+
+    with ScanPool(buf, jobs) as pool:
+        for kind, offset in merge_shards(pool.scan(shards), skip=skip, base=base, report=report):
+            yield kind, offset
+
+
+RecoveredRecord = namedtuple('RecoveredRecord', ['offset', 'eid', 'xml', 'num', 'timestamp'])
+
 
+def extract_chunk(buf, offset):
+    """
+    Generates the EVTX records and their templates from the EVTX chunk at the given offset.
+    The chunk is parsed, and each record rendered, only once to produce both.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): offset to EVTX chunk.
+
+    Returns:
+      iterable[tuple[RecoveredRecord, evtxtract.templates.Template]]: a generator of
+        each record and its template. the template is None if it could not be recovered.
+    """
     try:
         chunk = Evtx.Evtx.ChunkHeader(buf, offset)
     except:
@@ -212,7 +694,14 @@ def extract_chunk_templates(buf, offset):
     cache = {}
     for record in chunk.records():
         try:
-            yield evtxtract.templates.get_template(record)
+            record_xml = Evtx.Views.evtx_record_xml_view(record, cache=cache)
+            eid = evtxtract.utils.get_eid(record_xml)
+            try:
+                timestamp = record.timestamp()
+            except (ValueError, OverflowError, OSError):
+                timestamp = None
+            recovered = RecoveredRecord(record.offset(), eid, record_xml, record.record_num(), timestamp)
+
         except UnicodeEncodeError:
             logger.info("Unicode encoding issue processing record at 0x%X", record.offset())
             continue
@@ -225,10 +714,51 @@ def extract_chunk_templates(buf, offset):
             logger.info("EVTX parsing issue processing record at 0x%X", record.offset())
             continue
 
-        except Exception as e:
+        except Exception:
             logger.info("Unknown exception processing record at 0x%X", record.offset(), exc_info=True)
             continue
 
+        try:
+            template = evtxtract.templates.get_template(record, eid=eid, cache=cache)
+        except Exception:
+            logger.info("Unknown exception processing template of record at 0x%X", record.offset(), exc_info=True)
+            template = None
+
+        yield recovered, template
+
+
+def extract_chunk_records(buf, offset):
+    """
+    Generates EVTX records from the EVTX chunk at the given offset.
+    Prefer `extract_chunk` when the templates are needed, too.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): offset to EVTX chunk
+
+    Returns:
+      iterable[RecoveredRecord]: the records of the chunk.
+    """
+    for record, _ in extract_chunk(buf, offset):
+        yield record
+
+
+def extract_chunk_templates(buf, offset):
+    """
+    Generates EVTX record templates from the EVTX chunk at the given offset.
+    Prefer `extract_chunk` when the records are needed, too.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): offset to EVTX chunk.
+
+    Returns:
+      iterable[evtxtract.templates.Template]: a generator of the things you asked for.
+    """
+    for _, template in extract_chunk(buf, offset):
+        if template is not None:
+            yield template
+
 
 # map from byte value to boolean
 # the key values correspond to evtx node types
@@ -242,6 +772,168 @@ VALID_SUBSTITUTION_TYPES[129] = True
 class MaxOffsetReached(Exception): pass
 
 
+# precompiled structures for the fixed size substitution values.
+SUBSTITUTION_HEADER = struct.Struct("<HB")
+SIGNED_BYTE = struct.Struct("<b")
+UNSIGNED_BYTE = struct.Struct("<B")
+SIGNED_WORD = struct.Struct("<h")
+UNSIGNED_WORD = struct.Struct("<H")
+SIGNED_DWORD = struct.Struct("<i")
+UNSIGNED_DWORD = struct.Struct("<I")
+SIGNED_QWORD = struct.Struct("<q")
+UNSIGNED_QWORD = struct.Struct("<Q")
+FLOAT = struct.Struct("<f")
+DOUBLE = struct.Struct("<d")
+GUID = struct.Struct("<IHH2s6s")
+SYSTEMTIME = struct.Struct("<8H")
+SID_HEADER = struct.Struct("<BB")
+SID_AUTHORITY = struct.Struct(">IH")
+# the largest number of bytes read by a decoder regardless of the size of the value.
+MAX_FIXED_VALUE_SIZE = max(GUID.size, SYSTEMTIME.size)
+
+
+def _make_struct_decoder(s):
+    """
+    Create a substitution decoder that unpacks a single value with the given structure.
+
+    Args:
+      s (struct.Struct): the structure of the value.
+
+    Returns:
+      callable[[buffer, int, int], variant]: the decoder.
+    """
+    unpack_from = s.unpack_from
+
+    def decode(buf, ofs, size):
+        return unpack_from(buf, ofs)[0]
+    return decode
+
+
+def _decode_null(buf, ofs, size):
+    return None
+
+
+def _decode_wstring(buf, ofs, size):
+    return xml.sax.saxutils.escape(buf[ofs:ofs + size].decode('utf-16le'))
+
+
+def _decode_string(buf, ofs, size):
+    return xml.sax.saxutils.escape(buf[ofs:ofs + size].decode('ascii'))
+
+
+def _decode_boolean(buf, ofs, size):
+    return UNSIGNED_DWORD.unpack_from(buf, ofs)[0] > 1
+
+
+def _decode_binary(buf, ofs, size):
+    return binascii.hexlify(buf[ofs:ofs + size]).decode('ascii')
+
+
+def _decode_guid(buf, ofs, size):
+    data1, data2, data3, data4, data5 = GUID.unpack_from(buf, ofs)
+    return "%08x-%04x-%04x-%s-%s" % (data1, data2, data3,
+                                     binascii.hexlify(data4).decode('ascii'),
+                                     binascii.hexlify(data5).decode('ascii'))
+
+
+def _decode_size(buf, ofs, size):
+    if size == 0x4:
+        return UNSIGNED_DWORD.unpack_from(buf, ofs)[0]
+    elif size == 0x8:
+        return UNSIGNED_QWORD.unpack_from(buf, ofs)[0]
+    else:
+        raise ParseError('unexpected sizetypenode value: ' + hex(size))
+
+
+def _decode_filetime(buf, ofs, size):
+    qword = UNSIGNED_QWORD.unpack_from(buf, ofs)[0]
+    try:
+        return datetime.datetime.utcfromtimestamp(float(qword) * 1e-7 - 11644473600)
+    except ValueError:
+        raise ParseError('invalid timestamp')
+
+
+def _decode_systemtime(buf, ofs, size):
+    year, month, _, day, hour, minute, second, milliseconds = SYSTEMTIME.unpack_from(buf, ofs)
+    try:
+        # skip the day of week
+        return datetime.datetime(year, month, day, hour, minute, second, milliseconds * 1000)
+    except ValueError:
+        raise ParseError('invalid timestamp')
+
+
+def _decode_sid(buf, ofs, size):
+    version, num_elements = SID_HEADER.unpack_from(buf, ofs)
+    id_high, id_low = SID_AUTHORITY.unpack_from(buf, ofs + 2)
+    elements = struct.unpack_from("<%dI" % (num_elements), buf, ofs + 8)
+    return "S-%d-%d" % (version, (id_high << 16) ^ id_low) + "".join("-%d" % e for e in elements)
+
+
+def _decode_hex(buf, ofs, size):
+    # little endian, so the most significant byte is last.
+    return "0x" + binascii.hexlify(buf[ofs:ofs + size][::-1]).decode('ascii')
+
+
+def _decode_wstring_array(buf, ofs, size):
+    """
+    Decode a WstringArrayTypeNode: a sequence of NUL terminated UTF-16 strings.
+    The strings are found by searching for the NUL code units, so the value is scanned once.
+    A trailing empty string isn't reported, for compatibility with earlier versions.
+    """
+    if size % 2 != 0:
+        raise ParseError("Error parsing uneven wstring array")
+
+    value = []
+    end = ofs + size
+    start = ofs
+    while start < end:
+        nul = buf.find(b"\x00\x00", start, end)
+        # the NUL must be a code unit, not the high byte of one character and the low byte of the next.
+        while nul != -1 and (nul - ofs) % 2 != 0:
+            nul = buf.find(b"\x00\x00", nul + 1, end)
+        if nul == -1:
+            # the final string isn't terminated.
+            nul = end
+
+        value.append(xml.sax.saxutils.escape(buf[start:nul].decode("utf-16")))
+        start = nul + 2
+
+    if value and value[-1] == "":
+        value.pop()
+
+    return value
+
+
+# map from substitution type to the function that decodes its value,
+#  with the signature decoder(buf, offset, size) -> value.
+# the key values correspond to evtx node types.
+# BXmlTypeNode (0x21) contributes many substitutions, so it's handled by extract_root_substitutions.
+SUBSTITUTION_DECODERS = [None for _ in range(256)]
+SUBSTITUTION_DECODERS[0x0] = _decode_null
+SUBSTITUTION_DECODERS[0x1] = _decode_wstring
+SUBSTITUTION_DECODERS[0x2] = _decode_string
+SUBSTITUTION_DECODERS[0x3] = _make_struct_decoder(SIGNED_BYTE)
+SUBSTITUTION_DECODERS[0x4] = _make_struct_decoder(UNSIGNED_BYTE)
+SUBSTITUTION_DECODERS[0x5] = _make_struct_decoder(SIGNED_WORD)
+SUBSTITUTION_DECODERS[0x6] = _make_struct_decoder(UNSIGNED_WORD)
+SUBSTITUTION_DECODERS[0x7] = _make_struct_decoder(SIGNED_DWORD)
+SUBSTITUTION_DECODERS[0x8] = _make_struct_decoder(UNSIGNED_DWORD)
+SUBSTITUTION_DECODERS[0x9] = _make_struct_decoder(SIGNED_QWORD)
+SUBSTITUTION_DECODERS[0xA] = _make_struct_decoder(UNSIGNED_QWORD)
+SUBSTITUTION_DECODERS[0xB] = _make_struct_decoder(FLOAT)
+SUBSTITUTION_DECODERS[0xC] = _make_struct_decoder(DOUBLE)
+SUBSTITUTION_DECODERS[0xD] = _decode_boolean
+SUBSTITUTION_DECODERS[0xE] = _decode_binary
+SUBSTITUTION_DECODERS[0xF] = _decode_guid
+SUBSTITUTION_DECODERS[0x10] = _decode_size
+SUBSTITUTION_DECODERS[0x11] = _decode_filetime
+SUBSTITUTION_DECODERS[0x12] = _decode_systemtime
+SUBSTITUTION_DECODERS[0x13] = _decode_sid
+SUBSTITUTION_DECODERS[0x14] = _decode_hex
+SUBSTITUTION_DECODERS[0x15] = _decode_hex
+SUBSTITUTION_DECODERS[0x81] = _decode_wstring_array
+
+
 def does_root_have_resident_template(buf, offset, max_offset):
     """
     Guess whether an RootNode has a resident template
@@ -313,10 +1005,11 @@ def does_root_have_resident_template(buf, offset, max_offset):
     return False
 
 
-def extract_root_substitutions(buf, offset, max_offset):
+def find_root_substitutions(buf, offset, max_offset):
     """
-    Parse a RootNode into a list of its substitutions, not parsing beyond
-      the max offset.
+    Parse a RootNode into a list of the locations of its substitution values,
+      not parsing beyond the max offset.
+    The values aren't decoded.
 
     Args:
       buf (buffer): the binary data from which to extract structures.
@@ -324,10 +1017,10 @@ def extract_root_substitutions(buf, offset, max_offset):
       max_offset (int): don't parse beyond this address.
 
     Returns:
-      list[tuple[int, variant]]: list of substitution tuples (type, value).
+      list[tuple[int, int, int]]: list of tuples (type, offset, size).
 
     Raises:
-      ParseError: for various reasons, including invalid timestamps and overruns.
+      ParseError: for various reasons, including invalid types and overruns.
     """
     ofs = offset
     token = struct.unpack_from("<b", buf, ofs)[0]
@@ -359,7 +1052,7 @@ def extract_root_substitutions(buf, offset, max_offset):
 
     substitutions = []
     for _ in range(num_subs):
-        size, type_ = struct.unpack_from("<HB", buf, ofs)
+        size, type_ = SUBSTITUTION_HEADER.unpack_from(buf, ofs)
         if not VALID_SUBSTITUTION_TYPES[type_]:
             raise ParseError('Unexpected substitution type: ' + hex(type_))
 
@@ -367,209 +1060,209 @@ def extract_root_substitutions(buf, offset, max_offset):
         ofs += 4
 
     ret = []
-    for i, pair in enumerate(substitutions):
-        type_, size = pair
+    for type_, size in substitutions:
         if ofs > max_offset:
             raise MaxOffsetReached("Substitutions overran record buffer.")
 
-        value = None
-        #[0] = parse_null_type_node,
-        if type_ == 0x0:
-            value = None
-            ret.append((type_, value))
-
-        #[1] = parse_wstring_type_node,
-        elif type_ == 0x1:
-            s = buf[ofs:ofs + size]
-            s = s.decode('utf-16le')
-            s = xml.sax.saxutils.escape(s)
-            value = s
-            ret.append((type_, value))
-
-        #[2] = parse_string_type_node,
-        elif type_ == 0x2:
-            s = buf[ofs:ofs + size]
-            s = s.decode('ascii')
-            s = xml.sax.saxutils.escape(s)
-            value = s
-            ret.append((type_, value))
-
-        #[3] = parse_signed_byte_type_node,
-        elif type_ == 0x3:
-            value = struct.unpack_from("<b", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[4] = parse_unsigned_byte_type_node,
-        elif type_ == 0x4:
-            value = struct.unpack_from("<B", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[5] = parse_signed_word_type_node,
-        elif type_ == 0x5:
-            value = struct.unpack_from("<h", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[6] = parse_unsigned_word_type_node,
-        elif type_ == 0x6:
-            value = struct.unpack_from("<H", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[7] = parse_signed_dword_type_node,
-        elif type_ == 0x7:
-            value = struct.unpack_from("<i", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[8] = parse_unsigned_dword_type_node,
-        elif type_ == 0x8:
-            value = struct.unpack_from("<I", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[9] = parse_signed_qword_type_node,
-        elif type_ == 0x9:
-            value = struct.unpack_from("<q", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[10] = parse_unsigned_qword_type_node,
-        elif type_ == 0xA:
-            value = struct.unpack_from("<Q", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[11] = parse_float_type_node,
-        elif type_ == 0xB:
-            value = struct.unpack_from("<f", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[12] = parse_double_type_node,
-        elif type_ == 0xC:
-            value = struct.unpack_from("<d", buf, ofs)[0]
-            ret.append((type_, value))
-
-        #[13] = parse_boolean_type_node,
-        elif type_ == 0xD:
-            value = struct.unpack_from("<I", buf, ofs)[0] > 1
-            ret.append((type_, value))
-
-        #[14] = parse_binary_type_node,
-        elif type_ == 0xE:
-            value = binascii.hexlify(buf[ofs:ofs + size])
-            ret.append((type_, value))
-
-        #[15] = parse_guid_type_node,
-        elif type_ == 0xF:
-            _bin = buf[offset:offset + 16]
-
-            # Yeah, this is ugly
-            h = [six.indexbytes(_bin, i) for i in range(len(_bin))]
-            value = """{:02x}{:02x}{:02x}{:02x}-{:02x}{:02x}-{:02x}{:02x}-{:02x}{:02x}-{:02x}{:02x}{:02x}{:02x}{:02x}{:02x}""".format(
-                h[3], h[2], h[1], h[0],
-                h[5], h[4],
-                h[7], h[6],
-                h[8], h[9],
-                h[10], h[11], h[12], h[13], h[14], h[15])
-            ret.append((type_, value))
-
-        #[16] = parse_size_type_node,
-        elif type_ == 0x10:
-            if size == 0x4:
-                value = struct.unpack_from("<I", buf, ofs)[0]
-            elif size == 0x8:
-                value = struct.unpack_from("<Q", buf, ofs)[0]
-            else:
-                raise ParseError('unexpected sizetypenode value: ' + hex(size))
-
-            ret.append((type_, value))
-
-        #[17] = parse_filetime_type_node,
-        elif type_ == 0x11:
-            qword = struct.unpack_from("<Q", buf, ofs)[0]
-            try:
-                value = datetime.datetime.utcfromtimestamp(float(qword) * 1e-7 - 11644473600)
-            except ValueError:
-                raise ParseError('invalid timestamp')
-
-            ret.append((type_, value))
-
-        #[18] = parse_systemtime_type_node,
-        elif type_ == 0x12:
-            parts = struct.unpack_from("<WWWWWWWW", buf, ofs)
-            value = datetime.datetime(parts[0], parts[1],
-                                      parts[3],  # skip part 2 (day of week)
-                                      parts[4], parts[5],
-                                      parts[6], parts[7])
-            ret.append((type_, value))
-
-        #[19] = parse_sid_type_node,  -- SIDTypeNode, 0x13
-        elif type_ == 0x13:
-            version, num_elements = struct.unpack_from("<BB", buf, ofs)
-            id_high, id_low = struct.unpack_from(">IH", buf, ofs + 2)
-            value = "S-%d-%d" % (version, (id_high << 16) ^ id_low)
-            for i in range(num_elements):
-                val = struct.unpack_from("<I", buf, ofs + 8 + (4 * i))
-                value += "-%d" % val
-            ret.append((type_, value))
-
-        #[20] = parse_hex32_type_node,  -- Hex32TypeNoe, 0x14
-        elif type_ == 0x14:
-            value = "0x"
-            for c in buf[ofs:ofs + size][::-1]:
-                if not isinstance(c, (int)):
-                    c = ord(c)
-                value += "%02x" % c
-            ret.append((type_, value))
-
-        #[21] = parse_hex64_type_node,  -- Hex64TypeNode, 0x15
-        elif type_ == 0x15:
-            value = "0x"
-            for c in buf[ofs:ofs + size][::-1]:
-                if not isinstance(c, (int)):
-                    c = ord(c)
-                value += "%02x" % c
-            ret.append((type_, value))
-
-        #[33] = parse_bxml_type_node,  -- BXmlTypeNode, 0x21
-        elif type_ == 0x21:
-            subs = extract_root_substitutions(buf, ofs, max_offset)
-            ret.extend(subs)
-
-        #[129] = WstringArrayTypeNode, 0x81
-        elif type_ == 0x81:
-
-            value = []
-
-            bin = buf[ofs:ofs + size]
-            while len(bin) > 0:
-                match = re.search(b"((?:[^\x00].)+)", bin)
-                if match:
-                    frag = match.group()
-                    s = frag.decode("utf-16")
-                    s = xml.sax.saxutils.escape(s)
-                    value.append(s)
-                    bin = bin[len(frag) + 2:]
-                    if len(bin) == 0:
-                        break
-
-                frag = re.search(b"(\x00*)", bin).group()
-                if len(frag) % 2 == 0:
-                    for _ in range(len(frag) // 2):
-                        value.append('')
-
-                else:
-                    raise ParseError("Error parsing uneven substring of NULLs")
-
-                bin = bin[len(frag):]
-
-            if value[-1].strip("\x00") == "":
-                value = value[:-1]
-
-            ret.append((type_, value))
-
-        else:
+        if type_ == 0x21:
+            # BXmlTypeNode: an embedded RootNode, whose substitutions are flattened into this list.
+            ret.extend(find_root_substitutions(buf, ofs, max_offset))
+        elif SUBSTITUTION_DECODERS[type_] is None:
             raise ParseError("Unexpected type encountered: " + hex(type_))
+        else:
+            ret.append((type_, ofs, size))
 
         ofs += size
     return ret
 
 
+class Substitution(object):
+    """
+    A substitution of a record, which behaves like the tuple (type, value).
+    The value is decoded when it's first accessed, so indexing just the type is cheap.
+    """
+    __slots__ = ('_substitutions', '_index')
+
+    def __init__(self, substitutions, index):
+        super(Substitution, self).__init__()
+        self._substitutions = substitutions
+        self._index = index
+
+    @property
+    def type(self):
+        return self._substitutions.get_type(self._index)
+
+    @property
+    def value(self):
+        return self._substitutions.get_value(self._index)
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.type
+        return (self.type, self.value)[index]
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        yield self.type
+        yield self.value
+
+    def __repr__(self):
+        return repr((self.type, self.value))
+
+
+class Substitutions(object):
+    """
+    The substitutions of a record, which behaves like a list of tuples (type, value).
+    The types are parsed up front, so records can be matched against templates,
+      while each value is decoded when it's first accessed, so the values of records
+      that are never rendered are never decoded.
+
+    The bytes spanned by the values are copied,
+      so this doesn't keep a reference to the buffer from which they were parsed.
+    """
+    __slots__ = ('_data', '_entries', '_values')
+
+    def __init__(self, buf, entries):
+        """
+        Args:
+          buf (buffer): the binary data from which the substitutions were parsed.
+          entries (list[tuple[int, int, int]]): tuples (type, offset, size) locating each value in `buf`.
+        """
+        super(Substitutions, self).__init__()
+        if entries:
+            start = min(ofs for _, ofs, _ in entries)
+            # a fixed size value is read in full, even when its declared size is smaller.
+            end = max(ofs + max(size, MAX_FIXED_VALUE_SIZE) for _, ofs, size in entries)
+            self._data = bytes(buf[start:end])
+            self._entries = [(type_, ofs - start, size) for type_, ofs, size in entries]
+        else:
+            self._data = b""
+            self._entries = []
+        self._values = {}
+
+    def get_type(self, index):
+        return self._entries[index][0]
+
+    def get_types(self):
+        """
+        Returns:
+          list[int]: the type of each substitution.
+        """
+        return [type_ for type_, _, _ in self._entries]
+
+    def get_value(self, index):
+        """
+        Decode the value of the substitution at the given index, once.
+
+        Raises:
+          ParseError: if the value can't be decoded.
+        """
+        try:
+            return self._values[index]
+        except KeyError:
+            pass
+
+        type_, ofs, size = self._entries[index]
+        try:
+            value = SUBSTITUTION_DECODERS[type_](self._data, ofs, size)
+        except struct.error:
+            raise ParseError('buffer overrun')
+        except UnicodeDecodeError as e:
+            raise ParseError('invalid string: ' + str(e))
+
+        self._values[index] = value
+        return value
+
+    def get_data(self):
+        """
+        Returns:
+          bytes: the encoded values of all the substitutions.
+        """
+        return self._data
+
+    def get_value_data(self, index):
+        """
+        Returns:
+          bytes: the encoded value of the substitution at the given index.
+        """
+        _, ofs, size = self._entries[index]
+        return self._data[ofs:ofs + size]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self._entries)
+        if not 0 <= index < len(self._entries):
+            raise IndexError('substitution index out of range')
+        return Substitution(self, index)
+
+    def __iter__(self):
+        for index in range(len(self._entries)):
+            yield Substitution(self, index)
+
+    def __repr__(self):
+        return repr([tuple(substitution) for substitution in self])
+
+
+def extract_root_substitutions(buf, offset, max_offset):
+    """
+    Parse a RootNode into a list of its substitutions, not parsing beyond
+      the max offset.
+    The values are decoded when they're first accessed, which may raise ParseError.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): address of an EVTX record.
+      max_offset (int): don't parse beyond this address.
+
+    Returns:
+      Substitutions: sequence of substitution tuples (type, value).
+
+    Raises:
+      ParseError: for various reasons, including invalid types and overruns.
+    """
+    return Substitutions(buf, find_root_substitutions(buf, offset, max_offset))
+
+
+def get_record_digest(buf, offset, substitutions=None):
+    """
+    Hash the content of the EVTX record at the given offset: its record number, timestamp, and substitutions.
+    Copies of a record have the same digest wherever they're found,
+      such as in a valid chunk in one place, and carved from a damaged chunk in another.
+
+    Args:
+      buf (buffer): the binary data from which to extract structures.
+      offset (int): address of the EVTX record.
+      substitutions (Substitutions): the substitutions of the record, or None to parse them.
+
+    Returns:
+      bytes: the digest.
+    """
+    # the record number and timestamp.
+    digest = hashlib.md5(bytes(buf[offset + 0x8:offset + 0x18]))
+
+    if substitutions is None:
+        size = struct.unpack_from("<I", buf, offset + 0x4)[0]
+        try:
+            substitutions = extract_root_substitutions(buf, offset + 0x18, offset + size)
+        except (ParseError, struct.error):
+            # the record can't be compared by its substitutions, so compare it by its bytes.
+            digest.update(bytes(buf[offset + 0x18:offset + size]))
+            return digest.digest()
+
+    for index, type_ in enumerate(substitutions.get_types()):
+        data = substitutions.get_value_data(index)
+        digest.update(SUBSTITUTION_HEADER.pack(len(data), type_))
+        digest.update(data)
+    return digest.digest()
+
+
 ExtractedRecord = namedtuple(
     'ExtractedRecord', ['offset', 'num', 'timestamp', 'substitutions'])
 
@@ -0,0 +1,247 @@
+import os
+import time
+import pickle
+import logging
+import tempfile
+
+import evtxtract.utils
+
+
+logger = logging.getLogger(__name__)
+
+
+# the version of the state file format, bumped when the saved fields change.
+STATE_VERSION = 2
+
+# the minimum number of seconds between saved checkpoints.
+CHECKPOINT_INTERVAL = 60
+
+
+class CheckpointError(RuntimeError):
+    pass
+
+
+def _replace(src, dst):
+    # python 2.7 doesn't have os.replace, and os.rename won't overwrite on Windows.
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class Checkpoint(object):
+    '''
+    The progress of an extraction, periodically saved to a state file,
+      so that an interrupted extraction can be resumed where it left off.
+    With no path, nothing is saved, and this just tracks the progress.
+
+    The templates aren't saved. Instead, they're recovered again from the valid chunks.
+    The data of the record candidates is spilled to a file next to the state file,
+      so they can be resolved without reading the input again.
+    '''
+
+    def __init__(self, path=None, input_size=0, output=None, interval=CHECKPOINT_INTERVAL):
+        '''
+        Args:
+          path (str): the path to the state file, or None to not save checkpoints.
+          input_size (int): the size of the input, so the state isn't resumed against a different file.
+          output (file): the stream to which the records are written, if it may be truncated
+            to its size at the checkpoint when resuming.
+          interval (int): the minimum number of seconds between saved checkpoints.
+        '''
+        super(Checkpoint, self).__init__()
+        self.path = path
+        self.input_size = input_size
+        self.output = output
+        self.interval = interval
+
+        # the offset up to which the input has been scanned.
+        self.position = 0
+        # the offsets of the valid chunks found so far, in ascending order.
+        self.chunk_offsets = evtxtract.utils.offset_array()
+        # the regions of the input covered by records recovered from the valid chunks.
+        self.decoded = evtxtract.utils.IntervalIndex()
+        # the offsets of the record candidates to resolve once the scan completes, in ascending order.
+        self.record_offsets = evtxtract.utils.offset_array()
+        # the number of record candidates that have been resolved, and their records emitted.
+        self.resolved = 0
+        # the size of the output when the checkpoint was saved, or None if it can't be determined.
+        self.output_position = None
+        # the file holding the data of the record candidates, in the order of their offsets.
+        self.spill = None
+        # the number of bytes of record candidates spilled, when the checkpoint was saved.
+        self.spill_size = 0
+        # the offset in the spill of the next record candidate to resolve.
+        self.spill_position = 0
+
+        self._last_save = time.time()
+
+    def maybe_save(self):
+        '''
+        Save the checkpoint, if the interval has passed since it was last saved.
+        This is cheap to call often.
+        '''
+        if self.path is None:
+            return
+
+        if time.time() - self._last_save < self.interval:
+            return
+
+        self.save()
+
+    def save(self):
+        '''
+        Save the checkpoint to the state file.
+        The file is replaced atomically, so a crash while saving leaves the previous checkpoint intact.
+        '''
+        if self.spill is not None:
+            # the state must not refer to data that didn't make it to the spill.
+            self.spill.flush()
+            os.fsync(self.spill.fileno())
+
+        if self.output is not None:
+            self.output.flush()
+            try:
+                self.output_position = os.lseek(self.output.fileno(), 0, os.SEEK_CUR)
+            except (OSError, IOError):
+                # such as a pipe, or a database
+                self.output_position = None
+
+        state = {
+            'version': STATE_VERSION,
+            'input_size': self.input_size,
+            'position': self.position,
+            'chunk_offsets': self.chunk_offsets,
+            'decoded': self.decoded,
+            'record_offsets': self.record_offsets,
+            'resolved': self.resolved,
+            'output_position': self.output_position,
+            'spill_size': self.spill_size,
+            'spill_position': self.spill_position,
+        }
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            # from protocol 3, arrays are pickled as their raw bytes, rather than as lists of ints.
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(tmp_path, self.path)
+
+        logger.debug('saved checkpoint at offset 0x%x', self.position)
+        self._last_save = time.time()
+
+    @classmethod
+    def load(cls, path, input_size, output=None, interval=CHECKPOINT_INTERVAL):
+        '''
+        Load the checkpoint from the given state file.
+
+        Args:
+          path (str): the path to the state file.
+          input_size (int): the size of the input, which must match the size when the checkpoint was saved.
+          output (file): the stream to which the records are written.
+          interval (int): the minimum number of seconds between saved checkpoints.
+
+        Returns:
+          Checkpoint: the loaded checkpoint.
+
+        Raises:
+          CheckpointError: if the state file can't be used to resume this extraction.
+        '''
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            raise CheckpointError('failed to load state file: %s' % (str(e)))
+
+        if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+            raise CheckpointError('unsupported state file version')
+
+        if state['input_size'] != input_size:
+            raise CheckpointError('state file was saved for a different input')
+
+        checkpoint = cls(path, input_size, output=output, interval=interval)
+        checkpoint.position = state['position']
+        checkpoint.chunk_offsets = state['chunk_offsets']
+        checkpoint.decoded = state['decoded']
+        checkpoint.record_offsets = state['record_offsets']
+        checkpoint.resolved = state['resolved']
+        checkpoint.output_position = state['output_position']
+        checkpoint.spill_size = state['spill_size']
+        checkpoint.spill_position = state['spill_position']
+
+        if checkpoint.spill_size > 0:
+            try:
+                spill_size = os.path.getsize(checkpoint.spill_path)
+            except OSError:
+                spill_size = 0
+            if spill_size < checkpoint.spill_size:
+                raise CheckpointError('the record candidates spilled to %s are missing' % (checkpoint.spill_path))
+
+        return checkpoint
+
+    @property
+    def spill_path(self):
+        return self.path + '.spill'
+
+    def open_spill(self, memory_size):
+        '''
+        Open the file that holds the data of the record candidates,
+          restoring it to its size at the checkpoint when resuming.
+        With no state file, the data is held in memory until it grows beyond `memory_size` bytes,
+          and then in a temporary file.
+
+        Args:
+          memory_size (int): the number of bytes held in memory before spilling to disk, with no state file.
+
+        Returns:
+          file: the spill, positioned at its end.
+        '''
+        if self.path is None:
+            self.spill = tempfile.SpooledTemporaryFile(max_size=memory_size)
+        else:
+            self.spill = open(self.spill_path, 'r+b' if os.path.exists(self.spill_path) else 'w+b')
+            # discard the candidates spilled after the checkpoint, since they'll be spilled again.
+            self.spill.truncate(self.spill_size)
+        self.spill.seek(self.spill_size)
+        return self.spill
+
+    def restore_output(self):
+        '''
+        Truncate the output to its size at the checkpoint,
+          discarding the records emitted after the checkpoint was saved,
+          since they'll be emitted again.
+        '''
+        if self.output is None:
+            return
+
+        if self.output_position is None:
+            logger.warning('the output may contain duplicate records emitted after the last checkpoint')
+            return
+
+        self.output.flush()
+        try:
+            size = os.fstat(self.output.fileno()).st_size
+            if size >= self.output_position:
+                os.ftruncate(self.output.fileno(), self.output_position)
+                os.lseek(self.output.fileno(), self.output_position, os.SEEK_SET)
+                return
+        except OSError:
+            pass
+
+        logger.warning('the output does not continue the interrupted output, append to it with >>')
+
+    def remove(self):
+        '''
+        Delete the state file and the spill, once the extraction is complete.
+        '''
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+        if self.path is not None:
+            for path in (self.path, self.spill_path):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,282 @@
+import os
+import sys
+import logging
+import sqlite3
+import argparse
+import multiprocessing
+
+import Evtx.Evtx
+
+import evtxtract.utils
+import evtxtract.carvers
+import evtxtract.templates
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS templates (
+        id TEXT PRIMARY KEY,
+        eid INTEGER NOT NULL,
+        xml TEXT NOT NULL
+    )
+'''
+
+
+class TemplateLibrary(object):
+    '''
+    A persistent collection of templates, stored in a SQLite database and keyed by template id,
+      so that the templates recovered from one image can complete the records found in another.
+    When many templates share an id, the first one added to the library is kept.
+    '''
+
+    def __init__(self, path):
+        '''
+        Args:
+          path (str): the path to the database, which is created if it doesn't exist.
+        '''
+        super(TemplateLibrary, self).__init__()
+        self.path = path
+        self._db = None
+
+    def __enter__(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(SCHEMA)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._db:
+            if type is None:
+                self._db.commit()
+            self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM templates').fetchone()[0]
+
+    def __iter__(self):
+        '''
+        Returns:
+          iterable[evtxtract.templates.Template]: the templates in the library.
+        '''
+        for template_id, eid, xml in self._db.execute('SELECT id, eid, xml FROM templates'):
+            yield evtxtract.templates.Template(eid, xml, template_id=template_id)
+
+    def load(self, index):
+        '''
+        Add all the templates in the library to the given index.
+
+        Args:
+          index (evtxtract.templates.TemplateIndex): the index to which the templates are added.
+
+        Returns:
+          int: the number of templates loaded.
+        '''
+        count = 0
+        for template in self:
+            index.add(template)
+            count += 1
+        return count
+
+    def add(self, templates):
+        '''
+        Add the given templates to the library, skipping those whose id is already present.
+
+        Args:
+          templates (iterable[evtxtract.templates.Template]): the templates to add.
+
+        Returns:
+          int: the number of templates added.
+        '''
+        before = self._db.total_changes
+        self._db.executemany('INSERT OR IGNORE INTO templates (id, eid, xml) VALUES (?, ?, ?)',
+                             ((template.get_id(), template.eid, template.xml) for template in templates))
+        return self._db.total_changes - before
+
+    def merge(self, path):
+        '''
+        Add the templates from the library at the given path, skipping those whose id is already present.
+
+        Args:
+          path (str): the path to the other library.
+
+        Returns:
+          int: the number of templates added.
+        '''
+        # the attached database must be detached outside of a transaction.
+        self._db.commit()
+        self._db.execute('ATTACH DATABASE ? AS other', (path, ))
+        try:
+            before = self._db.total_changes
+            self._db.execute('INSERT OR IGNORE INTO templates (id, eid, xml) SELECT id, eid, xml FROM other.templates')
+            added = self._db.total_changes - before
+            self._db.commit()
+        finally:
+            self._db.execute('DETACH DATABASE other')
+        return added
+
+
+EVTX_FILE_MAGIC = b"ElfFile\x00"
+
+
+def find_evtx_files(paths):
+    '''
+    Find the .evtx files at the given paths, recursing into directories.
+
+    Args:
+      paths (iterable[str]): paths to files and directories.
+
+    Returns:
+      iterable[str]: the paths to .evtx files.
+    '''
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.evtx'):
+                    yield os.path.join(root, filename)
+
+
+def harvest_file(path):
+    '''
+    Collect the templates from the chunks of the given intact .evtx file.
+    The chunks are found using the file header, so the file isn't scanned for signatures.
+    Chunks that fail their checksums, such as unused chunks, are skipped.
+
+    Args:
+      path (str): the path to the .evtx file.
+
+    Returns:
+      list[tuple[str, int, str]]: tuples (template id, eid, xml) of the unique templates in the file.
+    '''
+    templates = {}
+    try:
+        with evtxtract.utils.Mmap(path) as buf:
+            if buf[:len(EVTX_FILE_MAGIC)] != EVTX_FILE_MAGIC:
+                logger.warning('not an EVTX file: %s', path)
+                return []
+
+            header = Evtx.Evtx.FileHeader(buf, 0x0)
+            offset = header.header_chunk_size()
+            while offset + evtxtract.carvers.CHUNK_SIZE <= len(buf):
+                if evtxtract.carvers.is_chunk_header(buf, offset):
+                    for template in evtxtract.carvers.extract_chunk_templates(buf, offset):
+                        template_id = template.get_id()
+                        if template_id not in templates:
+                            templates[template_id] = (template_id, template.eid, template.xml)
+                offset += evtxtract.carvers.CHUNK_SIZE
+    except (IOError, OSError, ValueError) as e:
+        # an empty file can't be mapped.
+        logger.warning('failed to read %s: %s', path, str(e))
+        return []
+
+    return list(templates.values())
+
+
+def harvest(paths, jobs=1):
+    '''
+    Collect the unique templates from the given .evtx files, using a pool of processes.
+
+    Args:
+      paths (iterable[str]): the paths to .evtx files.
+      jobs (int): the number of processes with which to harvest the files.
+
+    Returns:
+      iterable[evtxtract.templates.Template]: the templates, each with a distinct id.
+    '''
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(harvest_file, paths, chunksize=4)
+    else:
+        pool = None
+        results = (harvest_file(path) for path in paths)
+
+    seen = set([])
+    try:
+        for templates in results:
+            for template_id, eid, xml in templates:
+                if template_id in seen:
+                    continue
+                seen.add(template_id)
+                yield evtxtract.templates.Template(eid, xml, template_id=template_id)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Manage libraries of EVTX templates.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable debug logging")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Disable all output but errors")
+    subparsers = parser.add_subparsers(dest="command")
+
+    merge_parser = subparsers.add_parser("merge",
+                                         help="merge template libraries into a single library")
+    merge_parser.add_argument("output", type=str,
+                              help="Path to the library into which the templates are merged")
+    merge_parser.add_argument("input", type=str, nargs="+",
+                              help="Path to a library from which to merge templates")
+
+    harvest_parser = subparsers.add_parser("harvest",
+                                           help="collect the templates from intact .evtx files into a library")
+    harvest_parser.add_argument("output", type=str,
+                                help="Path to the library into which the templates are collected")
+    harvest_parser.add_argument("input", type=str, nargs="+",
+                                help="Path to an .evtx file, or a directory of .evtx files")
+    harvest_parser.add_argument("-j", "--jobs", type=int, default=1,
+                                help="number of processes with which to harvest the files")
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.quiet:
+        logging.basicConfig(level=logging.ERROR)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    if args.command == "merge":
+        with TemplateLibrary(args.output) as library:
+            for path in args.input:
+                if not os.path.isfile(path):
+                    logger.error('Error: %s is not a file', path)
+                    return 1
+
+                try:
+                    added = library.merge(path)
+                except sqlite3.Error as e:
+                    logger.error('Error: failed to merge %s: %s', path, str(e))
+                    return 1
+                logger.info('merged %d templates from %s', added, path)
+            logger.info('library contains %d templates', len(library))
+
+    elif args.command == "harvest":
+        if args.jobs < 1:
+            logger.error('Error: the -j argument must be at least 1')
+            return 1
+
+        with TemplateLibrary(args.output) as library:
+            added = library.add(harvest(find_evtx_files(args.input), jobs=args.jobs))
+            logger.info('harvested %d new templates', added)
+            logger.info('library contains %d templates', len(library))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,72 +1,67 @@
 import os
 import sys
+import stat
 import logging
 import os.path
 import argparse
 
 import evtxtract
 import evtxtract.carvers
+import evtxtract.output
+import evtxtract.library
+import evtxtract.templates
+import evtxtract.checkpoint
 
 
 logger = logging.getLogger(__name__)
 
 
-def output_record(args, r):
+def output_records(records, writer):
+    num_complete = 0
+    num_incomplete = 0
+    num_failed = 0
 
-    xmlhead = '<?xml version="1.0" encoding="UTF-8"?>\n<evtxtract>'
-    xmlfoot = '</evtxtract>'
-    if isinstance(r, evtxtract.CompleteRecord):
-        try:
-            if args.split:
-                fname = "{}-{}.xml".format(r.eid, r.offset)
-                fpath = os.path.join(args.out, fname)
-                with open(fpath, "wb") as f:
-                    f.write(xmlhead)
-                    f.write(r.xml.encode('utf-8'))
-                    f.write(xmlfoot)
-            else:
-                os.write(sys.stdout.fileno(), r.xml.encode('utf-8'))
-        except Exception as e:
-            logger.warn('failed to output record at offset: 0x%x: %s', r.offset, str(e), exc_info=True)
-        else:
-            sys.stdout.flush()
-
-    elif isinstance(r, evtxtract.IncompleteRecord):
-        try:
-            if args.split:
-                fname = "{}-{}-incomplete.xml".format(r.eid, r.offset)
-                fpath = os.path.join(args.out, fname)
-                with open(fpath, "wb") as f:
-                    f.write(xmlhead.encode('utf-8'))
-                    f.write(format_incomplete_record(r).encode('utf-8'))
-                    f.write(xmlfoot.encode('utf-8'))
-            else:
-                os.write(sys.stdout.fileno(), format_incomplete_record(r).encode('utf-8'))
-        except Exception as e:
-            logger.warn('failed to output record at offset: 0x%x: %s', r.offset, str(e), exc_info=True)
-        else:
-            sys.stdout.flush()
+    for r in records:
+        if not writer.write(r):
+            # such as a carved record with a substitution that can't be decoded.
+            num_failed += 1
 
+        elif isinstance(r, evtxtract.CompleteRecord):
+            num_complete += 1
 
-def format_incomplete_record(record):
-    ret = []
+        elif isinstance(r, evtxtract.IncompleteRecord):
+            num_incomplete += 1
 
-    ret.append('<Record>')
-    ret.append('<Offset>0x%x</Offset>' % (record.offset))
-    ret.append('<EventID>%d</EventID>' % (record.eid))
-    ret.append('<Substitutions>')
-    for i, (type_, value) in enumerate(record.substitutions):
-        ret.append('  <Substitution index="%d">' % (i))
-        ret.append('    <Type>%d</Type>' % (type_))
-        if value is None:
-            ret.append('    <Value></Value>')
         else:
-            ret.append('    <Value>%s</Value>' % (value))
-        ret.append('  </Substitution>')
-    ret.append('</Substitutions>')
-    ret.append('</Record>')
+            raise RuntimeError('unexpected return type')
+
+    logging.info('recovered %d complete records', num_complete)
+    logging.info('recovered %d incomplete records', num_incomplete)
+    if num_failed:
+        logging.info('failed to output %d records', num_failed)
+
 
-    return '\n'.join(ret)
+def open_writer(args, resume=False):
+    """
+    Open the writer for records written to stdout, a database, or split files.
+
+    Returns:
+      evtxtract.output.RecordWriter: the writer.
+    """
+    if args.sqlite:
+        return evtxtract.output.SqliteWriter(args.sqlite)
+    if args.split:
+        return evtxtract.output.SplitWriter(args.out, compression=args.compress)
+
+    stream = evtxtract.output.get_stdout()
+    if args.compress:
+        stream = evtxtract.output.CompressedStream(stream, args.compress)
+    # the writer stops the compression threads when it's closed, but stdout is left open.
+    close_stream = bool(args.compress)
+    if args.format == "jsonl":
+        return evtxtract.output.JsonLinesWriter(stream, close_stream=close_stream)
+    # when resuming, the header was written by the interrupted scan.
+    return evtxtract.output.XmlWriter(stream, header=not resume, close_stream=close_stream)
 
 
 def main(argv=None):
@@ -76,7 +71,7 @@ def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Reconstruct EVTX event log records from binary data.")
     parser.add_argument("input", type=str,
-                        help="Path to binary input file")
+                        help="Path to binary input file, which may be gzip, bzip2, or xz compressed, or - for stdin")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable debug logging")
     parser.add_argument("-q", "--quiet", action="store_true",
@@ -85,6 +80,25 @@ def main(argv=None):
                         help="split each event into its own file")
     parser.add_argument("-o", "--out", metavar='output-directory', action="store",
                         help="output directory to store split files")
+    parser.add_argument("-f", "--format", choices=["xml", "jsonl"], default="xml",
+                        help="output format: an XML document, or a JSON object per line")
+    parser.add_argument("--sqlite", metavar='database', action="store",
+                        help="write the records into this SQLite database, rather than to stdout")
+    parser.add_argument("--compress", choices=["gzip", "bz2", "xz"],
+                        help="compress the output, or each split file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes with which to scan the input")
+    parser.add_argument("-c", "--checkpoint", metavar='state-file', action="store",
+                        help="periodically save the progress of the scan to this file")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="resume an interrupted scan from the file given by --checkpoint. "
+                             "append the output to the interrupted output, such as with >>")
+    parser.add_argument("--dedup", action="store_true",
+                        help="skip copies of records, with the same record number, timestamp, and substitutions, "
+                             "such as those found in memory images and unallocated space")
+    parser.add_argument("-t", "--template-db", metavar='template-library', action="store",
+                        help="load templates from this library to complete more records, "
+                             "and save the templates recovered from the input to it")
     args = parser.parse_args()
 
     if args.verbose:
@@ -98,35 +112,91 @@ def main(argv=None):
         logger.error('Error: the -o argument is required when using -s. please provide an output directory with -o')
         exit(1)
 
-    if args.out and not os.path.isdir(args.out):
-        logger.error('Error: {0} is not a directory'.format(args.out))
+    if args.split and args.sqlite:
+        logger.error('Error: records can be split into files, or written to a database, but not both')
         exit(1)
 
-    with evtxtract.utils.Mmap(args.input) as mm:
-        num_complete = 0
-        num_incomplete = 0
+    if args.sqlite and args.compress:
+        logger.error('Error: a database can\'t be compressed')
+        exit(1)
 
-        if not args.split:
-            print('<?xml version="1.0" encoding="UTF-8"?>')
-            print('<evtxtract>')
-        for r in evtxtract.extract(mm):
-            
-            output_record(args, r)
+    if args.compress == "xz" and evtxtract.utils.lzma is None:
+        logger.error('Error: xz compression requires the lzma module')
+        exit(1)
 
-            if isinstance(r, evtxtract.CompleteRecord):
-                num_complete += 1
+    if args.split and args.format != "xml":
+        logger.error('Error: split files can only be written as XML')
+        exit(1)
 
-            elif isinstance(r, evtxtract.IncompleteRecord):
-                num_incomplete += 1
+    if args.jobs < 1:
+        logger.error('Error: the -j argument must be at least 1')
+        exit(1)
 
-            else:
-                raise RuntimeError('unexpected return type')
+    if args.out and not os.path.isdir(args.out):
+        logger.error('Error: {0} is not a directory'.format(args.out))
+        exit(1)
 
-        if not args.split:
-            print('</evtxtract>')
+    if args.resume and not args.checkpoint:
+        logger.error('Error: the -c argument is required when using -r. please provide the state file with -c')
+        exit(1)
+
+    if args.checkpoint and not args.resume and os.path.exists(args.checkpoint):
+        logger.error('Error: {0} already exists. use -r to resume the scan'.format(args.checkpoint))
+        exit(1)
 
-        logging.info('recovered %d complete records', num_complete)
-        logging.info('recovered %d incomplete records', num_incomplete)
+    templates = evtxtract.templates.TemplateIndex()
+    if args.template_db and os.path.exists(args.template_db):
+        with evtxtract.library.TemplateLibrary(args.template_db) as library:
+            count = library.load(templates)
+        logger.info('loaded %d templates from %s', count, args.template_db)
+
+    report = evtxtract.carvers.ScanReport()
+    # pipes and devices are read as streams, before anything consumes their data by peeking at it.
+    if args.input == '-' or not stat.S_ISREG(os.stat(args.input).st_mode) or evtxtract.utils.is_compressed(args.input):
+        if args.checkpoint:
+            logger.error('Error: only regular, uncompressed input files can be checkpointed')
+            exit(1)
+
+        if args.jobs > 1:
+            logger.warning('scanning a stream with a single process')
+        with evtxtract.utils.Stream(args.input) as f:
+            writer = open_writer(args)
+            records = evtxtract.extract_stream(f, report=report, templates=templates, dedup=args.dedup)
+            with writer:
+                output_records(records, writer)
+    else:
+        with evtxtract.utils.WindowedMmap(args.input, overlap=evtxtract.carvers.MAX_STRUCTURE_SIZE) as mm, \
+                evtxtract.carvers.ScanPool(args.input, jobs=args.jobs) as pool:
+            # the writer may start threads, so it's opened after the pool forks its workers.
+            writer = open_writer(args, resume=args.resume)
+            if args.resume:
+                try:
+                    checkpoint = evtxtract.checkpoint.Checkpoint.load(args.checkpoint, len(mm), output=writer)
+                except evtxtract.checkpoint.CheckpointError as e:
+                    logger.error('Error: {0}'.format(str(e)))
+                    exit(1)
+                if not (args.sqlite or args.split):
+                    # the database rows and split files of records emitted again are replaced,
+                    #  so they needn't be restored.
+                    checkpoint.restore_output()
+                logger.info('resuming from offset 0x%x', checkpoint.position)
+            else:
+                checkpoint = evtxtract.checkpoint.Checkpoint(args.checkpoint, len(mm), output=writer)
+
+            records = evtxtract.extract_windowed(mm, report=report, checkpoint=checkpoint, templates=templates,
+                                                 dedup=args.dedup, pool=pool)
+            with writer:
+                output_records(records, writer)
+            checkpoint.remove()
+
+    logging.info('skipped %d bytes of uniform pages', report.uniform_bytes)
+    if args.dedup:
+        logging.info('suppressed %d duplicate records', report.duplicate_records)
+
+    if args.template_db:
+        with evtxtract.library.TemplateLibrary(args.template_db) as library:
+            count = library.add(templates)
+        logger.info('saved %d new templates to %s', count, args.template_db)
 
 
 if __name__ == "__main__":
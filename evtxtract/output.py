@@ -0,0 +1,1052 @@
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import hashlib
+import logging
+import sqlite3
+import os.path
+import datetime
+import threading
+import collections
+import xml.sax.saxutils
+
+import six
+from lxml import etree
+
+import evtxtract
+import evtxtract.utils
+import evtxtract.carvers
+import evtxtract.templates
+
+
+logger = logging.getLogger(__name__)
+
+
+# the number of characters of output collected before they're written.
+OUTPUT_BUFFER_SIZE = 0x100000
+# the maximum number of seconds that output is held in the buffer.
+FLUSH_INTERVAL = 1.0
+
+
+def get_stdout():
+    '''
+    Open stdout as an unbuffered binary stream, bypassing the text layer of sys.stdout.
+
+    Returns:
+      file: the binary stream.
+    '''
+    sys.stdout.flush()
+    return io.open(sys.stdout.fileno(), 'wb', buffering=0, closefd=False)
+
+
+def write_all(stream, data):
+    '''
+    Write all the given data to a binary stream.
+
+    Args:
+      stream (file): the binary stream.
+      data (bytes): the data.
+    '''
+    data = memoryview(data)
+    while data:
+        # an unbuffered stream may accept only part of the data.
+        count = stream.write(data)
+        if count is None:
+            count = len(data)
+        data = data[count:]
+
+
+# the number of threads that compress output.
+COMPRESSION_THREADS = 4
+
+
+class _CompressionJob(object):
+    __slots__ = ('data', 'result', 'error', 'done')
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class CompressedStream(object):
+    '''
+    Compress the data written to a binary stream.
+    Each write is compressed separately by a pool of background threads,
+      so compression overlaps with the extraction,
+      and the results are written to the stream in order, as concatenated gzip, bzip2, or xz streams.
+    Standard tools decompress the concatenated streams as one.
+
+    Every flush completes the compressed streams, so the output can be truncated at a flush.
+    '''
+
+    def __init__(self, stream, compression, threads=COMPRESSION_THREADS):
+        '''
+        Args:
+          stream (file): the binary stream to which the compressed data is written.
+          compression (str): one of `gzip`, `bz2`, or `xz`.
+          threads (int): the number of threads that compress data.
+        '''
+        super(CompressedStream, self).__init__()
+        self.stream = stream
+        self.compression = compression
+        # the number of writes being compressed before a write blocks.
+        self.max_pending = 2 * threads
+
+        # the jobs not yet written to the stream, in order.
+        self._pending = collections.deque()
+        self._jobs = six.moves.queue.Queue()
+        self._threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                job.result = evtxtract.utils.compress(job.data, self.compression)
+            except Exception as e:
+                job.error = e
+            job.data = None
+            job.done.set()
+
+    def _write_completed(self, count):
+        '''
+        Write the compressed data of completed jobs, in order,
+          waiting for jobs until no more than the given number are pending.
+        '''
+        while self._pending:
+            job = self._pending[0]
+            if len(self._pending) > count:
+                job.done.wait()
+            elif not job.done.is_set():
+                break
+
+            self._pending.popleft()
+            if job.error is not None:
+                raise job.error
+            write_all(self.stream, job.result)
+
+    def write(self, data):
+        '''
+        Args:
+          data (bytes): the data to compress.
+
+        Returns:
+          int: the number of bytes written, which is all of them.
+        '''
+        data = memoryview(data).tobytes()
+        job = _CompressionJob(data)
+        self._pending.append(job)
+        self._jobs.put(job)
+        self._write_completed(self.max_pending)
+        return len(data)
+
+    def flush(self):
+        self._write_completed(0)
+        self.stream.flush()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def close(self):
+        '''
+        Write the remaining compressed data, and stop the threads.
+        The underlying stream is flushed, but left open.
+        '''
+        if not self._threads:
+            return
+
+        try:
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._jobs.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+
+class BufferedWriter(object):
+    '''
+    Collect text in a large buffer, and write it to a binary stream in batches,
+      encoding each batch in a single step, so there's one write per batch rather than per record.
+    The buffer is written when it fills, or when the flush interval has passed since the last write,
+      so a slow trickle of output isn't held back indefinitely.
+    '''
+
+    def __init__(self, stream, buffer_size=OUTPUT_BUFFER_SIZE, flush_interval=FLUSH_INTERVAL, encoding='utf-8',
+                 close_stream=False):
+        '''
+        Args:
+          stream (file): the binary stream to which the output is written.
+          buffer_size (int): the number of characters collected before they're written.
+          flush_interval (float): the maximum number of seconds that output is held in the buffer.
+          encoding (str): the encoding of the output.
+          close_stream (bool): close the stream when this is closed, such as a `CompressedStream` owned by this.
+        '''
+        super(BufferedWriter, self).__init__()
+        self.stream = stream
+        self.close_stream = close_stream
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.encoding = encoding
+
+        self._pieces = []
+        self._size = 0
+        self._last_flush = time.time()
+
+    def write(self, text):
+        '''
+        Args:
+          text (str): the text to write.
+        '''
+        self._pieces.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered text to the stream, and flush the stream.
+        '''
+        if self._pieces:
+            data = u''.join(self._pieces).encode(self.encoding)
+            self._pieces = []
+            self._size = 0
+            write_all(self.stream, data)
+
+        self.stream.flush()
+        self._last_flush = time.time()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def close(self):
+        '''
+        Write the buffered text to the stream, and close the stream if it's owned by this.
+        '''
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+def format_incomplete_record(record):
+    '''
+    Format a record that couldn't be reconstructed as XML, listing its substitutions.
+
+    Args:
+      record (evtxtract.IncompleteRecord): the record.
+
+    Returns:
+      str: the XML document.
+    '''
+    ret = []
+
+    ret.append('<Record>')
+    ret.append('<Offset>0x%x</Offset>' % (record.offset))
+    ret.append('<EventID>%d</EventID>' % (record.eid))
+    ret.append('<Substitutions>')
+    for i, (type_, value) in enumerate(record.substitutions):
+        ret.append('  <Substitution index="%d">' % (i))
+        ret.append('    <Type>%d</Type>' % (type_))
+        if value is None:
+            ret.append('    <Value></Value>')
+        else:
+            ret.append('    <Value>%s</Value>' % (value))
+        ret.append('  </Substitution>')
+    ret.append('</Substitutions>')
+    ret.append('</Record>')
+
+    return '\n'.join(ret)
+
+
+def format_record(record):
+    '''
+    Format a record as XML.
+
+    Args:
+      record (union[evtxtract.CompleteRecord, evtxtract.IncompleteRecord]): the record.
+
+    Returns:
+      str: the XML document.
+    '''
+    if isinstance(record, evtxtract.CompleteRecord):
+        return record.xml
+    elif isinstance(record, evtxtract.IncompleteRecord):
+        return format_incomplete_record(record)
+    else:
+        raise ValueError('unexpected record type')
+
+
+def _log_output_error(record, e):
+    if isinstance(e, evtxtract.carvers.ParseError):
+        # the substitutions of carved records are decoded as they're formatted,
+        #  so a record whose data is corrupt may only fail here.
+        logger.info('parse error for record at offset: 0x%x: %s', record.offset, str(e))
+    else:
+        logger.warn('failed to output record at offset: 0x%x: %s', record.offset, str(e), exc_info=True)
+
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<evtxtract>\n'
+XML_FOOTER = '</evtxtract>\n'
+
+
+class RecordWriter(object):
+    '''
+    Writes recovered records to an output.
+    Use as a context manager, so the output is completed and flushed at the end.
+    '''
+
+    def write(self, record):
+        '''
+        Write the given record.
+        A record that can't be formatted is logged and skipped.
+
+        Args:
+          record (union[evtxtract.CompleteRecord, evtxtract.IncompleteRecord]): the record.
+
+        Returns:
+          bool: True if the record was written, or False if it was skipped.
+        '''
+        raise NotImplementedError()
+
+    def flush(self):
+        '''
+        Write any buffered records to the output.
+        '''
+        pass
+
+    def close(self):
+        '''
+        Complete the output, and write any buffered records.
+        '''
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # keep the records emitted so far, but don't mark the output as complete.
+            self.flush()
+
+
+class XmlWriter(RecordWriter):
+    '''
+    Writes the records as a single XML document, with each record in the root <evtxtract> element.
+    '''
+
+    def __init__(self, stream, header=True, buffer_size=OUTPUT_BUFFER_SIZE, flush_interval=FLUSH_INTERVAL,
+                 close_stream=False):
+        '''
+        Args:
+          stream (file): the binary stream to which the document is written.
+          header (bool): write the header of the document,
+            which is omitted when appending to an interrupted document.
+          buffer_size (int): the number of characters collected before they're written.
+          flush_interval (float): the maximum number of seconds that output is held in the buffer.
+          close_stream (bool): close the stream when this is closed, such as a `CompressedStream` owned by this.
+        '''
+        super(XmlWriter, self).__init__()
+        self._out = BufferedWriter(stream, buffer_size=buffer_size, flush_interval=flush_interval,
+                                   close_stream=close_stream)
+        if header:
+            self._out.write(XML_HEADER)
+
+    def write(self, record):
+        try:
+            text = format_record(record)
+        except Exception as e:
+            _log_output_error(record, e)
+            return False
+        self._out.write(text)
+        return True
+
+    def flush(self):
+        self._out.flush()
+
+    def fileno(self):
+        return self._out.fileno()
+
+    def close(self):
+        self._out.write(XML_FOOTER)
+        self._out.close()
+
+    def __exit__(self, type, value, traceback):
+        super(XmlWriter, self).__exit__(type, value, traceback)
+        if type is not None:
+            self._out.close()
+
+
+def to_json_value(value):
+    '''
+    Convert a substitution value into a value that can be serialized as JSON.
+    Strings are unescaped, since they're decoded ready to be inserted into XML.
+
+    Args:
+      value (variant): the substitution value.
+
+    Returns:
+      variant: the JSON value.
+    '''
+    if isinstance(value, six.string_types):
+        if '&' not in value:
+            return value
+        return xml.sax.saxutils.unescape(value)
+    elif isinstance(value, list):
+        return [to_json_value(v) for v in value]
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        # not representable in JSON.
+        return str(value)
+    else:
+        return value
+
+
+class _Field(object):
+    '''
+    The text of an element or attribute of a template, which contains placeholders.
+    '''
+    __slots__ = ('pieces', )
+
+    def __init__(self, pieces):
+        '''
+        Args:
+          pieces (list[union[str, int]]): the literal text and the indices of the substitutions between them.
+        '''
+        super(_Field, self).__init__()
+        self.pieces = pieces
+
+    def render(self, get_value, count):
+        '''
+        Args:
+          get_value (callable[[int], variant]): fetch the value of the substitution at the given index.
+          count (int): the number of substitutions.
+
+        Returns:
+          variant: the typed value of the substitution, when the field is a single placeholder,
+            otherwise the text with the substitutions inserted.
+        '''
+        if len(self.pieces) == 1:
+            index = self.pieces[0]
+            if index >= count:
+                return None
+            return to_json_value(get_value(index))
+
+        ret = []
+        for piece in self.pieces:
+            if not isinstance(piece, int):
+                ret.append(piece)
+            elif piece < count:
+                ret.append(six.text_type(to_json_value(get_value(piece))))
+        return u''.join(ret)
+
+
+def _compile_field(text):
+    '''
+    Returns:
+      union[str, _Field]: the text, or a field if it contains placeholders.
+    '''
+    parts = evtxtract.templates.PLACEHOLDER_RE.split(text)
+    if len(parts) == 1:
+        return text
+
+    # split yields the literal text, followed by the mode, index, and type of each placeholder.
+    pieces = []
+    for i in range(0, len(parts), 4):
+        if parts[i]:
+            pieces.append(parts[i])
+        if i + 2 < len(parts):
+            pieces.append(int(parts[i + 2]))
+    return _Field(pieces)
+
+
+def _get_local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def _identity(value):
+    return value
+
+
+def element_to_map(element, convert=None):
+    '''
+    Convert an element of an event into a map of its fields.
+    An element with only text becomes its text. Otherwise, its attributes are collected
+      into `#attributes`, its children are keyed by their names, and its text is `#text`.
+    A <Data> element with a Name attribute, as found in <EventData>, is keyed by its name.
+    Children that share a name are collected into a list.
+
+    Args:
+      element (etree.Element): the element.
+      convert (callable[[str], variant]): if provided, converts the text and attribute values.
+
+    Returns:
+      variant: the field map.
+    '''
+    if convert is None:
+        convert = _identity
+
+    children = [child for child in element if isinstance(child.tag, six.string_types)]
+    text = element.text
+    if not children and not element.attrib:
+        return convert(text) if text else None
+
+    ret = collections.OrderedDict()
+    # the names of the children collected into lists.
+    repeated = set([])
+    if element.attrib:
+        ret['#attributes'] = collections.OrderedDict(
+            (_get_local_name(name), convert(value)) for name, value in element.attrib.items())
+
+    for child in children:
+        name = _get_local_name(child.tag)
+        key = child.get('Name')
+        if name == 'Data' and key is not None and len(child.attrib) == 1 and \
+                isinstance(convert(key), six.string_types):
+            name = key
+            value = convert(child.text) if child.text else None
+        else:
+            value = element_to_map(child, convert)
+
+        if name not in ret:
+            ret[name] = value
+        elif name in repeated:
+            ret[name].append(value)
+        else:
+            repeated.add(name)
+            ret[name] = [ret[name], value]
+
+    if text and text.strip():
+        ret['#text'] = convert(text)
+
+    return ret
+
+
+def encode_json_value(value):
+    '''
+    Serialize a JSON value, taking shortcuts for the common strings and integers.
+
+    Args:
+      value (variant): the JSON value.
+
+    Returns:
+      str: the JSON text.
+    '''
+    if isinstance(value, six.string_types):
+        return json.encoder.encode_basestring_ascii(value)
+    elif type(value) in six.integer_types:
+        return str(value)
+    else:
+        return json.dumps(value, separators=(',', ':'))
+
+
+def compile_json(node):
+    '''
+    Serialize a map compiled from a template into JSON text with holes for its fields,
+      so a record is serialized by serializing just its substitution values and joining the text.
+
+    Args:
+      node (variant): the map compiled from the template, see `element_to_map`.
+
+    Returns:
+      list[union[str, int, _Field]]: the literal JSON text, and between them, the fields,
+        or just the index of the substitution for a field that's a single placeholder.
+    '''
+    ret = []
+
+    def emit(node):
+        if isinstance(node, _Field):
+            if len(node.pieces) == 1:
+                # just the index of the substitution.
+                ret.append(node.pieces[0])
+            else:
+                ret.append(node)
+        elif isinstance(node, dict):
+            ret.append('{')
+            for i, (key, value) in enumerate(node.items()):
+                if i > 0:
+                    ret.append(',')
+                ret.append(encode_json_value(key) + ':')
+                emit(value)
+            ret.append('}')
+        elif isinstance(node, list):
+            ret.append('[')
+            for i, value in enumerate(node):
+                if i > 0:
+                    ret.append(',')
+                emit(value)
+            ret.append(']')
+        else:
+            ret.append(encode_json_value(node))
+    emit(node)
+
+    # merge the adjacent literal text.
+    parts = []
+    for part in ret:
+        if parts and isinstance(part, six.string_types) and isinstance(parts[-1], six.string_types):
+            parts[-1] += part
+        else:
+            parts.append(part)
+    return parts
+
+
+# an ampersand that doesn't begin a reference, or an angle bracket that doesn't begin markup.
+UNESCAPED_LITERAL_RE = re.compile(r'&(?!(?:[A-Za-z_][\w.-]*|#[0-9]+|#x[0-9A-Fa-f]+);)|<(?![A-Za-z_/!?])')
+
+
+def escape_template_literals(text):
+    '''
+    Escape the ampersands and angle brackets in the literal text of the given template view.
+    The view doesn't escape the literal text, so a template whose text contains them isn't well-formed XML.
+
+    Args:
+      text (str): the XML of the template view.
+
+    Returns:
+      str: the XML, with the stray ampersands and angle brackets escaped.
+    '''
+    return UNESCAPED_LITERAL_RE.sub(lambda match: '&amp;' if match.group(0) == '&' else '&lt;', text)
+
+
+class JsonLinesWriter(RecordWriter):
+    '''
+    Writes each record as a JSON object on its own line.
+
+    Complete records have the field map of the event, see `element_to_map`.
+    For carved records, the map is compiled into JSON text once per template,
+      and the typed substitution values are serialized into it, so the record is never rendered as XML.
+    Records recovered from intact chunks are only available as XML, which is parsed.
+
+    Incomplete records have the list of their typed substitutions.
+    '''
+
+    def __init__(self, stream, buffer_size=OUTPUT_BUFFER_SIZE, flush_interval=FLUSH_INTERVAL, close_stream=False):
+        '''
+        Args:
+          stream (file): the binary stream to which the records are written.
+          buffer_size (int): the number of characters collected before they're written.
+          flush_interval (float): the maximum number of seconds that output is held in the buffer.
+          close_stream (bool): close the stream when this is closed, such as a `CompressedStream` owned by this.
+        '''
+        super(JsonLinesWriter, self).__init__()
+        self._out = BufferedWriter(stream, buffer_size=buffer_size, flush_interval=flush_interval,
+                                   close_stream=close_stream)
+        # map from template to the JSON text compiled from it.
+        self._compiled = {}
+
+    def _get_compiled(self, template):
+        try:
+            return self._compiled[template]
+        except KeyError:
+            pass
+
+        try:
+            root = evtxtract.utils.to_lxml(template.xml)
+        except etree.XMLSyntaxError:
+            root = evtxtract.utils.to_lxml(escape_template_literals(template.xml))
+        self._compiled[template] = compile_json(element_to_map(root, _compile_field))
+        return self._compiled[template]
+
+    def format_event(self, record):
+        '''
+        Args:
+          record (evtxtract.CompleteRecord): the record.
+
+        Returns:
+          str: the field map of the event, as JSON.
+        '''
+        if record.template is None:
+            return encode_json_value(element_to_map(evtxtract.utils.to_lxml(record.xml)))
+
+        substitutions = record.substitutions
+        count = len(substitutions)
+        # fetch the values directly, rather than through each (type, value) pair.
+        get_value = getattr(substitutions, 'get_value', None)
+        if get_value is None:
+            def get_value(index):
+                return substitutions[index][1]
+
+        ret = []
+        for part in self._get_compiled(record.template):
+            if isinstance(part, six.string_types):
+                ret.append(part)
+            elif isinstance(part, int):
+                if part < count:
+                    ret.append(encode_json_value(to_json_value(get_value(part))))
+                else:
+                    ret.append('null')
+            else:
+                ret.append(encode_json_value(part.render(get_value, count)))
+        return ''.join(ret)
+
+    def format_record(self, record):
+        '''
+        Args:
+          record (union[evtxtract.CompleteRecord, evtxtract.IncompleteRecord]): the record.
+
+        Returns:
+          str: the JSON object.
+        '''
+        if isinstance(record, evtxtract.CompleteRecord):
+            return '{"offset":%d,"eid":%s,"complete":true,"event":%s}' % (
+                record.offset, encode_json_value(record.eid), self.format_event(record))
+        elif isinstance(record, evtxtract.IncompleteRecord):
+            substitutions = ','.join('{"type":%d,"value":%s}' % (type_, encode_json_value(to_json_value(value)))
+                                     for type_, value in record.substitutions)
+            return '{"offset":%d,"eid":%s,"complete":false,"substitutions":[%s]}' % (
+                record.offset, encode_json_value(record.eid), substitutions)
+        else:
+            raise ValueError('unexpected record type')
+
+    def write(self, record):
+        try:
+            text = self.format_record(record)
+        except Exception as e:
+            _log_output_error(record, e)
+            return False
+        self._out.write(text)
+        self._out.write('\n')
+        return True
+
+    def flush(self):
+        self._out.flush()
+
+    def fileno(self):
+        return self._out.fileno()
+
+    def close(self):
+        self._out.close()
+
+    def __exit__(self, type, value, traceback):
+        super(JsonLinesWriter, self).__exit__(type, value, traceback)
+        if type is not None:
+            self._out.close()
+
+
+SQLITE_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS records (
+        record_offset INTEGER PRIMARY KEY,
+        chunk_offset INTEGER,
+        complete INTEGER NOT NULL,
+        eid INTEGER,
+        num INTEGER,
+        timestamp TEXT,
+        xml TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS substitutions (
+        record_offset INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        type INTEGER NOT NULL,
+        value,
+        PRIMARY KEY (record_offset, position)
+    )
+    ''',
+)
+
+# indexes are built once the records are loaded, which is faster than maintaining them during the load.
+SQLITE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS records_eid ON records (eid)',
+    'CREATE INDEX IF NOT EXISTS records_timestamp ON records (timestamp)',
+    'CREATE INDEX IF NOT EXISTS records_chunk_offset ON records (chunk_offset)',
+)
+
+# the number of records collected before they're inserted.
+SQLITE_BATCH_SIZE = 0x1000
+# the number of records inserted in each transaction.
+SQLITE_TRANSACTION_SIZE = 0x40000
+
+
+def format_timestamp(timestamp):
+    '''
+    Format a timestamp in UTC as text that sorts chronologically, and that SQLite's date functions accept.
+
+    Args:
+      timestamp (datetime.datetime): the timestamp, which may be naive UTC, or timezone aware.
+
+    Returns:
+      str: the formatted timestamp, like `2013-03-23 02:05:57`.
+    '''
+    if timestamp is None:
+        return None
+    offset = timestamp.utcoffset()
+    if offset is not None:
+        timestamp = (timestamp - offset).replace(tzinfo=None)
+    return timestamp.isoformat(' ')
+
+
+def to_sqlite_value(value):
+    '''
+    Convert a substitution value into a value that can be stored in SQLite.
+
+    Args:
+      value (variant): the substitution value.
+
+    Returns:
+      union[int, float, str, None]: the SQLite value.
+    '''
+    if isinstance(value, datetime.datetime):
+        return format_timestamp(value)
+
+    value = to_json_value(value)
+    if isinstance(value, list):
+        return json.dumps(value)
+    elif isinstance(value, six.integer_types) and not -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+        # unsigned QWORDs don't fit in an SQLite integer.
+        return str(value)
+    else:
+        return value
+
+
+class SqliteWriter(RecordWriter):
+    '''
+    Writes the records into a SQLite database, with a row per record in the `records` table,
+      and a row per substitution of each carved record in the `substitutions` table.
+    Records are inserted in batches, within large transactions.
+
+    Rows are keyed by the offset of the record, so a record that is written again,
+      such as when resuming from a checkpoint, replaces the existing row.
+    '''
+
+    def __init__(self, path, batch_size=SQLITE_BATCH_SIZE, transaction_size=SQLITE_TRANSACTION_SIZE):
+        '''
+        Args:
+          path (str): the path to the database, which is created if it doesn't exist.
+          batch_size (int): the number of records collected before they're inserted.
+          transaction_size (int): the number of records inserted in each transaction.
+        '''
+        super(SqliteWriter, self).__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self.transaction_size = transaction_size
+
+        self._db = sqlite3.connect(path)
+        # the database can be rebuilt by running the extraction again,
+        #  so trade durability against power loss for the speed of the load.
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=OFF')
+        for statement in SQLITE_SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+
+        self._records = []
+        self._substitutions = []
+        self._uncommitted = 0
+
+    def write(self, record):
+        try:
+            if isinstance(record, evtxtract.CompleteRecord):
+                row = (record.offset, record.chunk_offset, 1, to_sqlite_value(record.eid),
+                       to_sqlite_value(record.num), format_timestamp(record.timestamp), record.xml)
+            elif isinstance(record, evtxtract.IncompleteRecord):
+                row = (record.offset, None, 0, to_sqlite_value(record.eid),
+                       to_sqlite_value(record.num), format_timestamp(record.timestamp), None)
+            else:
+                raise ValueError('unexpected record type')
+
+            substitutions = []
+            if record.substitutions is not None:
+                for i, (type_, value) in enumerate(record.substitutions):
+                    substitutions.append((record.offset, i, type_, to_sqlite_value(value)))
+        except Exception as e:
+            _log_output_error(record, e)
+            return False
+
+        self._records.append(row)
+        self._substitutions.extend(substitutions)
+        if len(self._records) >= self.batch_size:
+            self._insert()
+        return True
+
+    def _insert(self):
+        if not self._records:
+            return
+
+        self._db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)', self._records)
+        self._db.executemany('INSERT OR REPLACE INTO substitutions VALUES (?, ?, ?, ?)', self._substitutions)
+        self._uncommitted += len(self._records)
+        self._records = []
+        self._substitutions = []
+
+        if self._uncommitted >= self.transaction_size:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def flush(self):
+        self._insert()
+        self._db.commit()
+        self._uncommitted = 0
+
+    def fileno(self):
+        # so the checkpoint knows the output can't be truncated.
+        raise io.UnsupportedOperation('a database has no file descriptor')
+
+    def close(self):
+        self.flush()
+        for statement in SQLITE_INDEXES:
+            self._db.execute(statement)
+        self._db.commit()
+        self._db.close()
+
+    def __exit__(self, type, value, traceback):
+        super(SqliteWriter, self).__exit__(type, value, traceback)
+        if type is not None:
+            self._db.close()
+
+
+# the number of levels of subdirectories into which split files are sharded,
+#  each with up to 256 subdirectories, so no directory holds too many files.
+SPLIT_SHARD_LEVELS = 2
+# the number of threads that write split files.
+SPLIT_WRITER_THREADS = 4
+# the number of records handed to a thread at a time.
+SPLIT_BATCH_SIZE = 0x40
+# the number of batches waiting to be written before the extraction blocks.
+SPLIT_QUEUE_SIZE = 0x40
+
+
+class SplitWriter(RecordWriter):
+    '''
+    Writes each record into its own XML document, in a tree of subdirectories sharded by the hash of the file name.
+    The files are written by a pool of background threads, so the extraction continues while they're written.
+
+    Files are named by the EID and offset of the record, so a record that is written again,
+      such as when resuming from a checkpoint, replaces the existing file.
+    '''
+
+    def __init__(self, directory, compression=None, threads=SPLIT_WRITER_THREADS, batch_size=SPLIT_BATCH_SIZE,
+                 queue_size=SPLIT_QUEUE_SIZE):
+        '''
+        Args:
+          directory (str): the directory into which the files are written.
+          compression (str): compress each file with `gzip`, `bz2`, or `xz`, or None to leave them uncompressed.
+          threads (int): the number of threads that write, and compress, files.
+          batch_size (int): the number of records handed to a thread at a time.
+          queue_size (int): the number of batches waiting to be written before `write` blocks.
+        '''
+        super(SplitWriter, self).__init__()
+        self.directory = directory
+        self.compression = compression
+        self.batch_size = batch_size
+
+        self._batch = []
+
+        # the subdirectories known to exist.
+        self._directories = set()
+        self._queue = six.moves.queue.Queue(queue_size)
+        self._threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def get_path(record):
+        '''
+        Get the path of the file for the given record, relative to the output directory.
+
+        Args:
+          record (union[evtxtract.CompleteRecord, evtxtract.IncompleteRecord]): the record.
+
+        Returns:
+          str: the relative path, like `3a/7f/4624-1234.xml`.
+        '''
+        if isinstance(record, evtxtract.CompleteRecord):
+            name = '%d-%d.xml' % (record.eid, record.offset)
+        else:
+            name = '%d-%d-incomplete.xml' % (record.eid, record.offset)
+
+        digest = hashlib.md5(name.encode('ascii')).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in range(SPLIT_SHARD_LEVELS)]
+        return os.path.join(*(shards + [name]))
+
+    def write(self, record):
+        try:
+            text = format_record(record)
+            path = os.path.join(self.directory, self.get_path(record))
+            if self.compression:
+                path += evtxtract.utils.COMPRESSION_EXTENSIONS[self.compression]
+        except Exception as e:
+            _log_output_error(record, e)
+            return False
+
+        # directories are created here, rather than by the threads, so they don't race to create them.
+        directory = os.path.dirname(path)
+        if directory not in self._directories:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    logger.warn('failed to create directory: %s', directory, exc_info=True)
+                    return False
+            self._directories.add(directory)
+
+        self._batch.append((record.offset, path, text))
+        if len(self._batch) >= self.batch_size:
+            self._queue.put(self._batch)
+            self._batch = []
+        return True
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+
+                for offset, path, text in batch:
+                    try:
+                        data = (XML_HEADER + text + XML_FOOTER).encode('utf-8')
+                        if self.compression:
+                            data = evtxtract.utils.compress(data, self.compression)
+                        with open(path, 'wb') as f:
+                            f.write(data)
+                    except (OSError, IOError, RuntimeError) as e:
+                        logger.warn('failed to output record at offset: 0x%x: %s', offset, str(e), exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+        # wait until the files of the records written so far exist.
+        self._queue.join()
+
+    def fileno(self):
+        # so the checkpoint knows the output can't be truncated.
+        raise io.UnsupportedOperation('split files have no file descriptor')
+
+    def _stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        self.flush()
+        self._stop()
+
+    def __exit__(self, type, value, traceback):
+        super(SplitWriter, self).__exit__(type, value, traceback)
+        if type is not None:
+            self._stop()
@@ -1,6 +1,10 @@
 import re
 import sys
+import hashlib
 import logging
+import operator
+import itertools
+import collections
 
 import six
 import Evtx.Evtx
@@ -14,15 +18,60 @@ import evtxtract.templates
 logger = logging.getLogger(__name__)
 
 
+# it seems that some templates request different values than what are subsequently put in them
+#   specifically, a Hex64 might be put into a SizeType field (EID 4624)
+# this maps from the type described in a template, to possible additional types that a
+#   record can provide for a particular substitution
+TYPE_OVERRIDES = {
+    16: set([21])
+}
+
+# map from (type, is_conditional) to the frozenset of substitution types accepted by such a placeholder.
+# there are few distinct placeholders, so share the sets among all the templates.
+_accepted_types = {}
+
+
+def get_accepted_types(type_, is_conditional):
+    """
+    Get the substitution types accepted by a placeholder.
+
+    @type type_: int
+    @type is_conditional: boolean
+    @rtype: frozenset of int
+    """
+    key = (type_, is_conditional)
+    types = _accepted_types.get(key)
+    if types is None:
+        types = set([type_]) | TYPE_OVERRIDES.get(type_, set([]))
+        if is_conditional:
+            # a conditional substitution may be left empty
+            types.add(0)
+        types = frozenset(types)
+        _accepted_types[key] = types
+    return types
+
+
+# the placeholders in the text of a template, with groups (mode, index, type).
+PLACEHOLDER_RE = re.compile(r"\[(Conditional|Normal) Substitution\(index=(\d+), type=(\d+)\)\]")
+
+
 class Template(object):
-    substitition_re = re.compile("\[(Conditional|Normal) Substitution\(index=(\d+), type=(\d+)\)\]")
+    substitition_re = PLACEHOLDER_RE
 
-    def __init__(self, eid, xml):
+    def __init__(self, eid, xml, template_id=None):
+        """
+        @type eid: int
+        @type xml: str
+        @type template_id: str
+        @param template_id: the id of the template, if already known, such as from a template library.
+        """
         self.eid = eid
         self.xml = xml
 
         self._cached_placeholders = None
-        self._cached_id = None
+        self._cached_id = template_id
+        self._cached_constraints = None
+        self._cached_compiled = None
 
     def get_id(self):
         """
@@ -64,6 +113,35 @@ class Template(object):
         self._cached_placeholders = sorted(ret, key=lambda p: p[0])
         return self._cached_placeholders
 
+    def get_constraints(self):
+        """
+        Get the substitution types accepted at each index used by this template,
+          with the rules for conditional substitutions and type overrides applied.
+
+        @rtype: (tuple of int, tuple of frozenset of int, int)
+        @return: the indices used by the template in ascending order, the types accepted
+          at each of these indices, and the minimum number of substitutions.
+        """
+        if self._cached_constraints is not None:
+            return self._cached_constraints
+
+        placeholders = self._get_placeholders()
+        accepted = {}
+        for index, type_, is_conditional in placeholders:
+            types = get_accepted_types(type_, is_conditional)
+            if index in accepted:
+                # an index used by many placeholders must satisfy all of them
+                types = accepted[index] & types
+            accepted[index] = types
+
+        indices = tuple(sorted(accepted))
+        min_count = len(placeholders)
+        if indices:
+            min_count = max(min_count, indices[-1] + 1)
+
+        self._cached_constraints = (indices, tuple(accepted[i] for i in indices), min_count)
+        return self._cached_constraints
+
     def match_substitutions(self, substitutions):
         """
         Checks to see if the provided set of substitutions match the
@@ -77,98 +155,246 @@ class Template(object):
         @param substitutions: Tuple schema (type, value)
         @rtype: boolean
         """
-        logger = logging.getLogger("match_substitutions")
-        placeholders = self._get_placeholders()
-        logger.debug("Substitutions: %s", str(substitutions))
-        logger.debug("Constraints: %s", str(placeholders))
-        if len(placeholders) > len(substitutions):
-            logger.debug("Failing on lens: %d vs %d",
-                         len(placeholders), len(substitutions))
-            return False
-        if max(placeholders, key=lambda k: k[0])[0] > len(substitutions):
-            logger.debug("Failing on max index: %d vs %d",
-                         max(placeholders, key=lambda k: k[0])[0],
-                         len(substitutions))
+        indices, accepted, min_count = self.get_constraints()
+        if min_count > len(substitutions):
+            logger.debug("Failing on lens: %d vs %d", min_count, len(substitutions))
             return False
 
-        # it seems that some templates request different values than what are subsequently put in them
-        #   specifically, a Hex64 might be put into a SizeType field (EID 4624)
-        # this maps from the type described in a template, to possible additional types that a
-        #   record can provide for a particular substitution
-        overrides = {
-            16: set([21])
-        }
+        for index, types in zip(indices, accepted):
+            sub_type = substitutions[index][0]
+            if sub_type not in types:
+                logger.debug("Failing on type comparison, index %d: %d vs %s",
+                             index, sub_type, sorted(types))
+                return False
+        return True
 
-        for index, type_, is_conditional in placeholders:
-            sub_type, sub_value = substitutions[index]
-            if is_conditional and sub_type == 0:
+    def insert_substitutions(self, substitutions):
+        """
+        Return a copy of the template with the given substitutions inserted.
+        Placeholders for which there is no substitution are left as-is.
+
+        @type substitutions: list of (int, str)
+        @param substitutions: an ordered list of (type:int, value:str)
+        @rtype: str
+        """
+        if self._cached_compiled is None:
+            self._cached_compiled = compile_template(self.xml)
+        literals, slots = self._cached_compiled
+
+        count = len(substitutions)
+        ret = [literals[0]]
+        for (index, placeholder), literal in zip(slots, literals[1:]):
+            if index < count:
+                value = substitutions[index][1]
+                if not isinstance(value, six.string_types):
+                    value = str(value)
+                ret.append(value)
+            else:
+                ret.append(placeholder)
+            ret.append(literal)
+        return "".join(ret)
+
+
+class _TemplateGroup(object):
+    """
+    The templates for an EID that use the same substitution indices.
+    These are indexed by the types of the substitutions at those indices.
+
+    Conditional substitutions may be empty (type 0), which would make each conditional
+      index a wildcard. So, there is a separate hash table for each set of empty
+      indices, built the first time a record with that set of empty indices is looked up.
+    """
+
+    def __init__(self, indices):
+        super(_TemplateGroup, self).__init__()
+        self.indices = indices
+        self.min_count = indices[-1] + 1 if indices else 0
+        self._get_types = operator.itemgetter(*indices) if len(indices) > 1 else \
+            (lambda types: tuple(types[i] for i in indices))
+        # map from template id to template
+        self.templates = {}
+        # map from the tuple of empty indices, to map from the tuple of the remaining
+        #   substitution types, to the list of matching templates.
+        self._tables = {}
+
+    def add(self, template):
+        self.templates[template.get_id()] = template
+        self._tables = {}
+
+    def _build_table(self, empty):
+        """
+        @type empty: tuple of bool
+        @param empty: for each index of the group, is the substitution empty?
+        @rtype: dict of tuple of int to list of Template
+        """
+        table = collections.defaultdict(list)
+        for template in self.templates.values():
+            _, accepted, _ = template.get_constraints()
+            if any(is_empty and 0 not in types for is_empty, types in zip(empty, accepted)):
                 continue
-            if sub_type != type_:
-                if type_ not in overrides or sub_type not in overrides[type_]:
-                    logger.debug("Failing on type comparison, index %d: %d vs %d (mode: %s)",
-                                 index, sub_type, type_, is_conditional)
-                    return False
-                else:
-                    logger.debug("Overriding template type %d with substitution type %d", type_, sub_type)
-                    continue
-        return True
 
-    escape_re = re.compile(r"\\\\(\d)")
+            # the overrides are the only way that an index accepts many non-empty types,
+            #  so this product is very small.
+            choices = [sorted(types - set([0])) for is_empty, types in zip(empty, accepted) if not is_empty]
+            for key in itertools.product(*choices):
+                table[key].append(template)
+        return dict(table)
 
-    @staticmethod
-    def _escape(value):
+    def match(self, types, count):
+        """
+        @type types: list of int
+        @param types: the type of each substitution.
+        @type count: int
+        @param count: the number of substitutions.
+        @rtype: list of Template
         """
-        Escape the static value to be used in a regular expression
-          subsititution. This processes any backreferences and
-          makes them plain, escaped sequences.
+        if self.min_count > count:
+            return []
 
-        @type value: str
-        @rtype: str
+        values = self._get_types(types)
+        empty = tuple(value == 0 for value in values)
+
+        table = self._tables.get(empty)
+        if table is None:
+            table = self._build_table(empty)
+            self._tables[empty] = table
+
+        key = tuple(value for value in values if value != 0)
+        return [template for template in table.get(key, [])
+                if template.get_constraints()[2] <= count]
+
+
+class TemplateIndex(object):
+    """
+    Templates indexed by EID and the types of the substitutions they accept,
+      so finding the templates that match a record is a few hash lookups,
+      rather than checking each of the templates for the EID.
+
+    The templates match exactly the records that `Template.match_substitutions` accepts.
+    Like a dict keyed by template id, a template replaces any prior template with the same id.
+
+    The templates for an EID aren't indexed until a record with that EID is looked up,
+      so that adding a large library of templates is cheap.
+    """
+
+    def __init__(self):
+        super(TemplateIndex, self).__init__()
+        # map from eid to map from tuple of substitution indices to _TemplateGroup
+        self._groups = collections.defaultdict(dict)
+        # map from eid to map from template id to template, for the templates not yet indexed.
+        self._pending = collections.defaultdict(dict)
+
+    def add(self, template):
+        """
+        @type template: Template
         """
-        return Template.escape_re.sub(r"\\\\\\\\\1", re.escape(value))
+        self._pending[template.eid][template.get_id()] = template
 
-    def insert_substitutions(self, substitutions):
+    def _get_groups(self, eid):
         """
-        Return a copy of the template with the given substitutions inserted.
+        Index the pending templates for the given EID, and get its groups of templates.
 
+        @type eid: int
+        @rtype: dict of tuple of int to _TemplateGroup
+        """
+        pending = self._pending.pop(eid, None)
+        if pending:
+            groups = self._groups[eid]
+            for template in pending.values():
+                indices = template.get_constraints()[0]
+                group = groups.get(indices)
+                if group is None:
+                    group = _TemplateGroup(indices)
+                    groups[indices] = group
+                group.add(template)
+        return self._groups.get(eid, {})
+
+    def __len__(self):
+        return sum(len(self.get_templates(eid)) for eid in set(self._groups) | set(self._pending))
+
+    def __iter__(self):
+        for eid in set(self._groups) | set(self._pending):
+            for template in self.get_templates(eid):
+                yield template
+
+    def get_templates(self, eid):
+        """
+        @type eid: int
+        @rtype: list of Template
+        """
+        return [template for group in self._get_groups(eid).values() for template in group.templates.values()]
+
+    def match(self, eid, substitutions):
+        """
+        Find the templates for the given EID that can accept the given substitutions.
+
+        @type eid: int
         @type substitutions: list of (int, str)
-        @param substitutions: an ordered list of (type:int, value:str)
-        @rtype: str
+        @param substitutions: Tuple schema (type, value)
+        @rtype: list of Template
         """
-        ret = self.xml
-        for index, pair in enumerate(substitutions):
-            type_, value = pair
-            from_pattern = "\[(Normal|Conditional) Substitution\(index=%d, type=\d+\)\]" % index
-            if isinstance(value, six.string_types):
-                value = Template._escape(value)
-            else:
-                value = str(value)
-            ret = re.sub(from_pattern, value, ret)
+        groups = self._get_groups(eid)
+        if not groups:
+            return []
+
+        # index just the type, so lazily decoded values aren't decoded.
+        types = [substitution[0] for substitution in substitutions]
+        ret = []
+        for group in groups.values():
+            ret.extend(group.match(types, len(types)))
         return ret
 
 
-REPLACEMENT_PATTERNS = {
-    i: re.compile(
-        "\[(Normal|Conditional) Substitution\(index=%d, type=\d+\)\]" % i)
-    for i in range(35)}
+def compile_template(xml):
+    """
+    Split the given template text into the literal text between the placeholders,
+      and the placeholders themselves, so the placeholders can be filled in with
+      a single join, rather than searching the text for each placeholder.
 
+    Implementation depends on the brittle template_format() output.
 
-def make_replacement(template, index, substitution):
+    @type xml: str
+    @rtype: (list of str, list of (int, str))
+    @return: the literal segments, and for each placeholder, its index and text.
+      there is one more literal segment than there are placeholders, and the
+      placeholders fall between the literal segments.
     """
-    Makes a substitution given a template as a string.
+    literals = []
+    slots = []
+    last = 0
+    for match in PLACEHOLDER_RE.finditer(xml):
+        literals.append(xml[last:match.start()])
+        slots.append((int(match.group(2)), match.group(0)))
+        last = match.end()
+    literals.append(xml[last:])
+    return literals, slots
 
-    Implementation is a huge hack that depends on the
-    brittle template_format() output.
 
-    @type template: str
-    @type index: int
-    @type substitution: str
+# the maximum number of template views kept by `get_template_view`.
+TEMPLATE_CACHE_SIZE = 0x1000
+
+# map from (template guid, hash of template body) to the readable view of the template.
+# the same templates appear in chunk after chunk, so this is shared by all the chunks.
+_template_views = evtxtract.utils.LRUCache(TEMPLATE_CACHE_SIZE)
+
+
+def get_template_view(root):
+    """
+    Get the readable view of the template used by the given RootNode,
+      reusing the view of an identical template seen in a prior chunk.
+
+    @type root: RootNode
     @rtype: str
     """
-    if index not in REPLACEMENT_PATTERNS:
-        from_pattern = re.compile("\[(Normal|Conditional) Substitution\(index=%d, type=\d+\)\]" % index)
-        REPLACEMENT_PATTERNS[index] = from_pattern
-    return REPLACEMENT_PATTERNS[index].sub(substitution, template)
+    template = root.template()
+    body = template.unpack_binary(template.tag_length(), template.data_length())
+    key = (template.unpack_binary(0x4, 0x10), hashlib.md5(body).digest())
+
+    view = _template_views.get(key)
+    if view is None:
+        view = Evtx.Views.evtx_template_readable_view(root)
+        _template_views.put(key, view)
+    return view
 
 
 def get_complete_template(root, current_index=0):
@@ -184,7 +410,7 @@ def get_complete_template(root, current_index=0):
     @type current_index: int
     @rtype: str
     """
-    template = Evtx.Views.evtx_template_readable_view(root)  # TODO(wb): make sure this is working
+    template = get_template_view(root)  # TODO(wb): make sure this is working
 
     # walk through each substitution.
     # if its a normal node, continue
@@ -201,30 +427,41 @@ def get_complete_template(root, current_index=0):
                                              current_index=current_index + index)
         replacements.append(subtemplate)
         current_index += subtemplate.count("Substitution(index=")
-    replacements.reverse()
-
-    # now walk through all the indices and fix them up depth-first
-    for i, replacement in enumerate(replacements):
-        index = len(replacements) - i - 1
-        if isinstance(replacement, int):
-            # fixup index
-            from_pattern = "index=%d," % index
-            to_pattern = "index=%d," % replacement
-            template = template.replace(from_pattern, to_pattern)
-        if isinstance(replacement, six.string_types):
-            # insert sub-template
-            template = make_replacement(template, index, replacement)
-    return template
-
-
-def get_template(record):
+
+    if all(replacement == index for index, replacement in enumerate(replacements)):
+        # there are no sub-templates, and the indices don't change.
+        return template
+
+    # now walk through the placeholders, and fix up their indices or insert the sub-templates.
+    literals, slots = compile_template(template)
+    ret = [literals[0]]
+    for (index, placeholder), literal in zip(slots, literals[1:]):
+        if index < len(replacements):
+            replacement = replacements[index]
+            if isinstance(replacement, int):
+                # fixup index
+                placeholder = placeholder.replace("index=%d," % index, "index=%d," % replacement)
+            else:
+                # insert sub-template
+                placeholder = replacement
+        ret.append(placeholder)
+        ret.append(literal)
+    return "".join(ret)
+
+
+def get_template(record, eid=None, cache=None):
     """
     Given a complete Record, parse out the nodes that make up the Template
       and return it as a Template.
 
     @type record: Record
+    @type eid: int
+    @param eid: the EID of the record, if already known, such as when the record was just rendered.
+    @type cache: dict
+    @param cache: the python-evtx cache shared by the records of the chunk.
     @rtype: Template
     """
-    record_xml = Evtx.Views.evtx_record_xml_view(record)
-    eid = evtxtract.utils.get_eid(record_xml)
+    if eid is None:
+        record_xml = Evtx.Views.evtx_record_xml_view(record, cache=cache)
+        eid = evtxtract.utils.get_eid(record_xml)
     return Template(eid, get_complete_template(record.root()))
@@ -1,7 +1,25 @@
+import io
+import os
+import re
+import bz2
+import sys
+import gzip
+import math
 import mmap
+import zlib
+import array
+import bisect
+import struct
 import logging
+import collections
 from lxml import etree
 
+try:
+    import lzma
+except ImportError:
+    # python 2.7 doesn't ship with lzma
+    lzma = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -33,9 +51,14 @@ def get_child(node, tag,
     return node.find("%s%s" % (ns, tag))
 
 
+EID_RE = re.compile(r"<EventID(?:\s[^>]*)?>\s*(\d+)\s*</EventID>")
+
+
 def get_eid(record_xml):
     """
     Given EVTX record XML, return the EID of the record.
+    The EID is found by scanning the System element of the string,
+      and only when that fails is the whole record parsed as XML.
 
     Args:
       record_xml (str)
@@ -43,6 +66,14 @@ def get_eid(record_xml):
     Returns:
       int: the event ID of the record
     """
+    end = record_xml.find("</System>")
+    if end == -1:
+        end = len(record_xml)
+
+    match = EID_RE.search(record_xml, 0, end)
+    if match is not None:
+        return int(match.group(1))
+
     return int(
         get_child(
             get_child(to_lxml(record_xml),
@@ -71,3 +102,375 @@ class Mmap(object):
             self._mmap.close()
         if  self._f :
             self._f.close()
+
+
+# the size of each region mapped by WindowedMmap.
+# must be a multiple of mmap.ALLOCATIONGRANULARITY.
+WINDOW_SIZE = 0x10000000
+
+
+def _madvise(m, advice):
+    """
+    Advise the kernel how the given mapping will be accessed, where supported.
+    mmap.madvise is only available on python 3.8+, and the advice constants vary by platform.
+
+    @type m: mmap.mmap
+    @type advice: str
+    """
+    advice = getattr(mmap, advice, None)
+    if advice is not None and hasattr(m, 'madvise'):
+        m.madvise(advice)
+
+
+class WindowedMmap(object):
+    """
+    Convenience class for opening a file path as a sequence of read-only memory mapped windows.
+    Only one window is mapped at a time, so resident memory and page table overhead
+      stay bounded regardless of the size of the file.
+
+    Each window extends `overlap` bytes into the following window,
+      so a structure that begins within a window can be parsed in place.
+    """
+
+    def __init__(self, filename, window_size=WINDOW_SIZE, overlap=0):
+        super(WindowedMmap, self).__init__()
+        if window_size % mmap.ALLOCATIONGRANULARITY != 0:
+            raise ValueError('window size must be a multiple of 0x%x' % (mmap.ALLOCATIONGRANULARITY))
+        self._filename = filename
+        self._window_size = window_size
+        self._overlap = overlap
+        self._f = None
+        self._size = 0
+
+    def __enter__(self):
+        self._f = open(self._filename, "rb")
+        self._size = os.fstat(self._f.fileno()).st_size
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._f:
+            self._f.close()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def window_size(self):
+        return self._window_size
+
+    def windows(self, start=0):
+        """
+        Generate the windows of the file in order, beginning with the window that contains `start`.
+        A window is unmapped when the next one is requested, so don't hold on to it, or views of it.
+
+        @type start: int
+        @rtype: iterable[tuple[int, mmap.mmap, int]]
+        @return: tuples (base, buf, end), where `base` is the offset of the window within the file,
+          and `end` is the offset within `buf` at which the next window begins.
+        """
+        base = start - (start % self._window_size)
+        while base < self._size:
+            length = min(self._window_size + self._overlap, self._size - base)
+            m = mmap.mmap(self._f.fileno(), length, access=mmap.ACCESS_READ, offset=base)
+            try:
+                _madvise(m, 'MADV_SEQUENTIAL')
+                yield base, m, min(self._window_size, length)
+                _madvise(m, 'MADV_DONTNEED')
+            finally:
+                m.close()
+
+            if hasattr(os, 'posix_fadvise'):
+                # the scan won't come back to this window soon,
+                #  so don't let it crowd everything else out of the page cache.
+                os.posix_fadvise(self._f.fileno(), base, self._window_size, os.POSIX_FADV_DONTNEED)
+
+            base += self._window_size
+
+
+# leading bytes of the compressed formats that Stream transparently decompresses.
+COMPRESSION_MAGICS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+
+
+def get_compression(f):
+    """
+    Identify the compression format of the given buffered stream, without consuming any data.
+
+    @type f: io.BufferedReader
+    @rtype: str or None
+    """
+    header = f.peek(6)[:6]
+    for magic, name in COMPRESSION_MAGICS:
+        if header.startswith(magic):
+            return name
+    return None
+
+
+def is_compressed(filename):
+    """
+    Is the file at the given path compressed with gzip, bzip2, or xz?
+
+    @type filename: str
+    @rtype: bool
+    """
+    with io.open(filename, "rb") as f:
+        return get_compression(f) is not None
+
+
+# file name extensions of the compressed formats that `compress` produces.
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+}
+
+
+def compress(data, compression):
+    """
+    Compress the given data into a complete gzip, bzip2, or xz stream.
+    The streams of separately compressed data can be concatenated,
+      and they're decompressed as a single stream.
+
+    @type data: bytes
+    @type compression: str
+    @param compression: one of `gzip`, `bz2`, or `xz`.
+    @rtype: bytes
+    """
+    if compression == 'gzip':
+        # the window bits select the gzip header and trailer, rather than zlib's.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif compression == 'bz2':
+        return bz2.compress(data)
+    elif compression == 'xz':
+        if lzma is None:
+            raise RuntimeError('xz compression requires the lzma module')
+        return lzma.compress(data)
+    else:
+        raise ValueError('unsupported compression: %s' % (compression))
+
+
+class Stream(object):
+    """
+    Convenience class for opening a file path, or stdin given `-`, as a sequential binary stream.
+    gzip, bzip2, and xz compressed data is decompressed on the fly.
+    """
+
+    def __init__(self, filename):
+        super(Stream, self).__init__()
+        self._filename = filename
+        self._f = None
+        self._stream = None
+
+    def __enter__(self):
+        if self._filename == "-":
+            self._f = io.open(sys.stdin.fileno(), "rb", closefd=False)
+        else:
+            self._f = io.open(self._filename, "rb")
+
+        compression = get_compression(self._f)
+        if compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._f, mode="rb")
+        elif compression == 'bz2':
+            self._stream = bz2.BZ2File(self._f, mode="rb")
+        elif compression == 'xz':
+            if lzma is None:
+                raise RuntimeError('xz decompression requires the lzma module')
+            self._stream = lzma.LZMAFile(self._f, mode="rb")
+        else:
+            self._stream = self._f
+        return self._stream
+
+    def __exit__(self, type, value, traceback):
+        if self._stream and self._stream is not self._f:
+            self._stream.close()
+        if self._f:
+            self._f.close()
+
+
+class LRUCache(object):
+    """
+    A map with a bounded number of entries.
+    When full, adding an entry evicts the least recently used entry.
+    """
+
+    def __init__(self, size):
+        """
+        @type size: int
+        @param size: the maximum number of entries.
+        """
+        super(LRUCache, self).__init__()
+        self._size = size
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        @return: the value for the key, or `default` if it isn't present.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        # move the entry to the most recently used end.
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _get_offset_typecode():
+    # python 2.7 has no 'Q' typecode, but 'L' is 64 bits on most 64-bit platforms.
+    for typecode in ('Q', 'L'):
+        try:
+            if array.array(typecode).itemsize >= 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+
+# the typecode of arrays of 64-bit offsets, or None when there isn't one, such as python 2.7 on Windows.
+OFFSET_TYPECODE = _get_offset_typecode()
+
+
+def offset_array(offsets=()):
+    """
+    Create a compact sequence of 64-bit offsets.
+    When the platform has no suitable array typecode, this is a list.
+
+    @type offsets: iterable[int]
+    @rtype: array.array or list
+    """
+    if OFFSET_TYPECODE is None:
+        return list(offsets)
+    return array.array(OFFSET_TYPECODE, offsets)
+
+
+class IntervalIndex(object):
+    """
+    A set of disjoint, half-open intervals [start, end), kept in sorted arrays
+      so that the interval containing an offset can be found by bisection.
+    Overlapping and adjacent intervals are merged, so a run of contiguous
+      structures, such as the records of a chunk, costs a single entry.
+    """
+
+    def __init__(self):
+        super(IntervalIndex, self).__init__()
+        self._starts = offset_array()
+        self._ends = offset_array()
+
+    def add(self, start, end):
+        """
+        Add the interval [start, end) to the index.
+
+        @type start: int
+        @type end: int
+        """
+        # the intervals in [i, j) overlap or touch the new interval.
+        i = bisect.bisect_left(self._ends, start)
+        j = bisect.bisect_right(self._starts, end)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j - 1])
+        self._starts[i:j] = offset_array([start])
+        self._ends[i:j] = offset_array([end])
+
+    def find(self, offset):
+        """
+        Find the end of the interval that contains the given offset.
+
+        @type offset: int
+        @rtype: int or None
+        @return: the end of the containing interval, or None if no interval contains the offset.
+        """
+        i = bisect.bisect_right(self._starts, offset) - 1
+        if i >= 0 and offset < self._ends[i]:
+            return self._ends[i]
+        return None
+
+    def __contains__(self, offset):
+        return self.find(offset) is not None
+
+    def __len__(self):
+        return len(self._starts)
+
+    def gaps(self, start, end):
+        """
+        Generate the parts of the range [start, end) not covered by the index.
+
+        @type start: int
+        @type end: int
+        @rtype: iterable of (int, int)
+        """
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i < 0:
+            i = 0
+        while start < end:
+            if i < len(self._starts) and self._starts[i] <= start:
+                # `start` may be covered by interval `i`, so jump over it.
+                start = max(start, self._ends[i])
+                i += 1
+                continue
+
+            if i < len(self._starts):
+                gap_end = min(self._starts[i], end)
+            else:
+                gap_end = end
+            yield start, gap_end
+            start = gap_end
+
+
+class BloomFilter(object):
+    """
+    A set of keys in a fixed amount of memory, which may report that a key is present when it isn't.
+    The rate of false positives is about `error_rate` until `capacity` keys are added, and grows after that.
+    Keys must be uniformly distributed, such as digests, and at least 16 bytes long.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        @type capacity: int
+        @param capacity: the expected number of keys.
+        @type error_rate: float
+        @param error_rate: the rate of false positives when the filter holds `capacity` keys.
+        """
+        super(BloomFilter, self).__init__()
+        self._size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self._hashes = max(1, int(round(float(self._size) / capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def add(self, key):
+        """
+        Add the key to the set.
+
+        @type key: bytes
+        @rtype: bool
+        @return: True if the key may have been present already, False if it definitely wasn't.
+        """
+        # derive the bit indices from two halves of the key, by double hashing.
+        h1, h2 = struct.unpack_from('<QQ', key)
+        present = True
+        for i in range(self._hashes):
+            bit = (h1 + i * h2) % self._size
+            mask = 1 << (bit & 7)
+            if not self._bits[bit >> 3] & mask:
+                self._bits[bit >> 3] |= mask
+                present = False
+        return present
@@ -21,6 +21,7 @@ setuptools.setup(name="evtxtract",
       entry_points={
           "console_scripts": [
               "evtxtract=evtxtract.main:main",
+              "evtxtract-templates=evtxtract.library:main",
           ]
       },
       install_requires=[
@@ -29,4 +30,8 @@ setuptools.setup(name="evtxtract",
           'pytest',
           'python-evtx>=0.5.2',
       ],
+      extras_require={
+          # validates record candidates in bulk
+          'numpy': ['numpy'],
+      },
 )
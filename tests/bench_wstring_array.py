@@ -0,0 +1,85 @@
+'''
+Microbenchmark for decoding WstringArrayTypeNode (0x81) substitutions,
+  comparing the linear decoder with the regular expression based decoder it replaced.
+
+usage: python tests/bench_wstring_array.py
+'''
+import re
+import sys
+import timeit
+import xml.sax.saxutils
+
+import evtxtract.carvers
+
+
+def regex_decode_wstring_array(buf, ofs, size):
+    '''
+    The previous decoder, which searches and re-slices the remaining data for each string.
+    '''
+    value = []
+
+    bin = buf[ofs:ofs + size]
+    while len(bin) > 0:
+        match = re.search(b"((?:[^\x00].)+)", bin)
+        if match:
+            frag = match.group()
+            s = frag.decode("utf-16")
+            s = xml.sax.saxutils.escape(s)
+            value.append(s)
+            bin = bin[len(frag) + 2:]
+            if len(bin) == 0:
+                break
+
+        frag = re.search(b"(\x00*)", bin).group()
+        if len(frag) % 2 == 0:
+            for _ in range(len(frag) // 2):
+                value.append('')
+
+        else:
+            raise evtxtract.carvers.ParseError("Error parsing uneven substring of NULLs")
+
+        bin = bin[len(frag):]
+
+    if value[-1].strip("\x00") == "":
+        value = value[:-1]
+
+    return value
+
+
+def make_wstring_array(count, length):
+    '''
+    Encode an array of `count` strings, each `length` characters long, with some empty strings mixed in.
+    '''
+    strings = []
+    for i in range(count):
+        if i % 8 == 7:
+            strings.append(u'')
+        else:
+            strings.append((u'%d<value>&' % i).ljust(length, u'x')[:length])
+    return b''.join(s.encode('utf-16le') + b'\x00\x00' for s in strings)
+
+
+def main():
+    decoders = (
+        ('regex', regex_decode_wstring_array),
+        ('linear', evtxtract.carvers._decode_wstring_array),
+    )
+
+    for count, length in ((4, 16), (64, 16), (512, 16), (4096, 16), (64, 256)):
+        data = make_wstring_array(count, length)
+        assert regex_decode_wstring_array(data, 0, len(data)) == \
+            evtxtract.carvers._decode_wstring_array(data, 0, len(data))
+
+        number = max(1, 200000 // (count * length))
+        results = []
+        for name, decoder in decoders:
+            elapsed = min(timeit.repeat(lambda: decoder(data, 0, len(data)), number=number, repeat=3))
+            results.append('%s: %8.1f us' % (name, elapsed / number * 1e6))
+
+        print('%5d strings x %3d chars (%6d bytes): %s' % (count, length, len(data), ', '.join(results)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,7 @@
 import os
+import zlib
+import struct
+import hashlib
 
 import pytest
 
@@ -28,3 +31,194 @@ def image_mmap(request):
     with evtxtract.utils.Mmap(image(request)) as mm:
         yield mm
 
+
+NS = u'http://schemas.microsoft.com/win/2004/08/events/event'
+
+
+class _BinaryXml(object):
+    '''
+    Builds a fragment of binary XML, tracking the chunk offsets of the names it defines.
+    '''
+
+    def __init__(self, base):
+        self.base = base
+        self.data = bytearray()
+        self.names = {}
+
+    def _name(self, name, extra=b''):
+        if name in self.names:
+            self.data += struct.pack('<I', self.names[name]) + extra
+            return
+        self.names[name] = self.base + len(self.data) + 4 + len(extra)
+        self.data += struct.pack('<I', self.names[name]) + extra
+        self.data += struct.pack('<IHH', 0, 0, len(name)) + name.encode('utf-16le') + b'\x00\x00'
+
+    def _value(self, value):
+        if isinstance(value, tuple):
+            index, type_ = value
+            self.data += struct.pack('<BHB', 0x0D, index, type_)
+        else:
+            self.data += struct.pack('<BBH', 0x05, 0x01, len(value)) + value.encode('utf-16le')
+
+    def element(self, tag, value=None, attrs=(), children=()):
+        self.data += struct.pack('<BHI', 0x41 if attrs else 0x01, 0xFFFF, 0)
+        self._name(tag, struct.pack('<I', 0) if attrs else b'')
+        for i, (name, attr) in enumerate(attrs):
+            self.data += b'\x46' if i < len(attrs) - 1 else b'\x06'
+            self._name(name)
+            self._value(attr)
+        self.data += b'\x02'
+        if value is not None:
+            self._value(value)
+        for child in children:
+            child()
+        self.data += b'\x04'
+
+
+def _template_body(base):
+    xml = _BinaryXml(base)
+    xml.data += b'\x0f\x01\x01\x00'
+    xml.element(u'Event', attrs=[(u'xmlns', NS)], children=[
+        lambda: xml.element(u'System', children=[
+            lambda: xml.element(u'EventID', (3, 0x06)),
+            lambda: xml.element(u'Level', (0, 0x04)),
+            lambda: xml.element(u'Task', (1, 0x04)),
+            lambda: xml.element(u'Version', (2, 0x06)),
+            lambda: xml.element(u'TimeCreated', attrs=[(u'SystemTime', (4, 0x11))]),
+            lambda: xml.element(u'Computer', (5, 0x01)),
+        ]),
+        lambda: xml.element(u'EventData', children=[
+            lambda: xml.element(u'Data', (6, 0x08)),
+        ]),
+    ])
+    xml.data += b'\x00'
+    return bytes(xml.data)
+
+
+def _filetime(num):
+    return 130084371570000000 + num * 10000000
+
+
+def _record(offset, num, eid, template_offset):
+    '''
+    Build the record with the given number and EID at the given chunk offset.
+    The template is defined within the record when `template_offset` is None.
+    '''
+    root = bytearray(b'\x0f\x01\x01\x00')
+    if template_offset is None:
+        template_offset = offset + 0x18 + 4 + 10
+        body = _template_body(template_offset + 0x18)
+        root += struct.pack('<BBII', 0x0C, 0x01, eid, template_offset)
+        root += struct.pack('<I16sI', 0, hashlib.md5(struct.pack('<I', eid)).digest(), len(body)) + body
+    else:
+        root += struct.pack('<BBII', 0x0C, 0x01, eid, template_offset)
+
+    computer = u'HOST-%d' % (num)
+    values = [
+        (0x04, struct.pack('<B', 4)),
+        (0x04, struct.pack('<B', num % 0x100)),
+        (0x06, struct.pack('<H', 0)),
+        (0x06, struct.pack('<H', eid)),
+        (0x11, struct.pack('<Q', _filetime(num))),
+        (0x01, computer.encode('utf-16le')),
+        (0x08, struct.pack('<I', 1000 + num)),
+    ]
+    root += struct.pack('<I', len(values))
+    for type_, value in values:
+        root += struct.pack('<HBB', len(value), type_, 0)
+    for type_, value in values:
+        root += value
+
+    size = (0x18 + len(root) + 4 + 7) & ~7
+    data = struct.pack('<IIQQ', 0x2a2a, size, num, _filetime(num)) + bytes(root)
+    data += b'\x00' * (size - 4 - len(data)) + struct.pack('<I', size)
+    return data, template_offset
+
+
+def make_chunk(first_num, eids, corrupt=False):
+    '''
+    Build a 64KB chunk with a record for each of the given EIDs, numbered from `first_num`.
+    '''
+    data = bytearray()
+    templates = {}
+    last = 0x200
+    for i, eid in enumerate(eids):
+        last = 0x200 + len(data)
+        record, templates[eid] = _record(last, first_num + i, eid, templates.get(eid))
+        data += record
+
+    header = bytearray(0x200)
+    last_num = first_num + len(eids) - 1
+    struct.pack_into('<8sQQQQIII', header, 0, b'ElfChnk\x00', first_num, last_num, first_num, last_num,
+                     0x80, last, 0x200 + len(data))
+    struct.pack_into('<I', header, 0x34, zlib.crc32(bytes(data)) & 0xFFFFFFFF)
+    struct.pack_into('<I', header, 0x7C, zlib.crc32(bytes(header[:0x78] + header[0x80:])) & 0xFFFFFFFF)
+    if corrupt:
+        header[0x10] ^= 0xFF
+    chunk = bytes(header) + bytes(data)
+    return chunk + b'\x00' * (0x10000 - len(chunk))
+
+
+def make_evtx(chunks):
+    '''
+    Build an .evtx file with a file header followed by the given chunks.
+    '''
+    header = bytearray(0x1000)
+    struct.pack_into('<8sQQQIHHHH', header, 0, b'ElfFile\x00', 0, len(chunks) - 1, 1, 0x80, 1, 3, 0x1000, len(chunks))
+    struct.pack_into('<I', header, 0x7C, zlib.crc32(bytes(header[:0x78])) & 0xFFFFFFFF)
+    return bytes(header) + b''.join(chunks)
+
+
+def _noise(size, seed):
+    return b''.join(hashlib.sha256(struct.pack('<II', seed, i)).digest() for i in range(size // 32))
+
+
+# the records in the synthetic image.
+SYNTHETIC_CHUNK_RECORDS = 12
+SYNTHETIC_CARVED_RECORDS = 12
+SYNTHETIC_INCOMPLETE_RECORDS = 1
+SYNTHETIC_DUPLICATE_RECORDS = 6
+
+
+def make_synthetic_image():
+    '''
+    Build a 4MB image with two valid chunks, one straddling the 2MB boundary, a corrupted chunk,
+      a copy of the records of the first chunk outside of any chunk, a record with an unknown EID,
+      and zero, constant, and random pages.
+
+    Returns:
+      bytes: the image.
+    '''
+    image = bytearray(0x400000)
+    image[0x40000:0x80000] = _noise(0x40000, 1)
+    image[0x90000:0xA0000] = b'\xFF' * 0x10000
+    image[0x340000:0x360000] = _noise(0x20000, 2)
+
+    eids = [1, 2, 1, 2, 1, 1]
+    image[0x100000:0x110000] = make_chunk(1, eids)
+    image[0x1F8000:0x208000] = make_chunk(7, eids)
+    # the records of a corrupted chunk are carved, and completed using the templates of the valid chunks.
+    image[0x280000:0x290000] = make_chunk(13, eids, corrupt=True)
+    # copies of the records of the first chunk, outside of any chunk.
+    image[0x300008:0x301000] = image[0x100200:0x1011F8]
+    # a record whose template isn't in any chunk.
+    record, _ = _record(0x200, 100, 77, None)
+    image[0x380000:0x380000 + len(record)] = record
+    # stray signatures.
+    image[0x345000:0x345004] = b'\x2a\x2a\x00\x00'
+    image[0x346000:0x346007] = b'ElfChnk'
+    return bytes(image)
+
+
+@pytest.fixture
+def synthetic_image(tmpdir):
+    path = str(tmpdir.join('synthetic.img'))
+    with open(path, 'wb') as f:
+        f.write(make_synthetic_image())
+    return path
+
+
+@pytest.fixture
+def synthetic_mmap(synthetic_image):
+    with evtxtract.utils.Mmap(synthetic_image) as mm:
+        yield mm
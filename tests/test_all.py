@@ -1,7 +1,24 @@
+import io
+import os
+import bz2
+import gzip
+import json
+import struct
+import hashlib
+import sqlite3
 import logging
+import datetime
+
+import pytest
+import lxml.etree
 
 import evtxtract
+import evtxtract.utils
 import evtxtract.carvers
+import evtxtract.output
+import evtxtract.library
+import evtxtract.checkpoint
+import evtxtract.templates
 
 from fixtures import *
 
@@ -153,3 +170,576 @@ def test_evtxtract(image_mmap):
 
     assert num_complete == 52
     assert num_incomplete == 1615
+
+
+def count_records(records):
+    records = list(records)
+    complete = sum(1 for r in records if isinstance(r, evtxtract.CompleteRecord))
+    incomplete = sum(1 for r in records if isinstance(r, evtxtract.IncompleteRecord))
+    return complete, incomplete
+
+
+def summarize(records):
+    return sorted((r.offset, r.eid, isinstance(r, evtxtract.CompleteRecord)) for r in records)
+
+
+SYNTHETIC_COUNTS = (SYNTHETIC_CHUNK_RECORDS + SYNTHETIC_CARVED_RECORDS, SYNTHETIC_INCOMPLETE_RECORDS)
+
+
+def test_extract_synthetic(synthetic_mmap):
+    assert count_records(evtxtract.extract(synthetic_mmap)) == SYNTHETIC_COUNTS
+
+
+def test_offset_array():
+    # python 2.7 has no 'Q' typecode, so another typecode must hold 64-bit offsets.
+    offsets = evtxtract.utils.offset_array([0, 2 ** 63])
+    assert list(offsets) == [0, 2 ** 63]
+
+
+def test_find_structures(synthetic_mmap):
+    # the single pass scanner must find exactly what the dedicated scanners find.
+    chunks = []
+    records = []
+    for kind, offset in evtxtract.carvers.find_evtx_structures(synthetic_mmap):
+        if kind == evtxtract.carvers.EVTX_CHUNK:
+            chunks.append(offset)
+        elif kind == evtxtract.carvers.EVTX_RECORD:
+            records.append(offset)
+        else:
+            raise RuntimeError('unexpected structure kind')
+
+    assert chunks == list(evtxtract.carvers.find_evtx_chunks(synthetic_mmap))
+    assert records == list(evtxtract.carvers.find_evtx_records(synthetic_mmap))
+    assert len(chunks) == 2
+
+
+def test_find_structures_parallel(synthetic_mmap, monkeypatch):
+    # sharding must not change the results, or their order.
+    monkeypatch.setattr(evtxtract.carvers, 'SCAN_BLOCK_SIZE', 0x40000)
+    monkeypatch.setattr(evtxtract.carvers, 'MIN_SHARD_SIZE', 0x40000)
+    assert list(evtxtract.carvers.find_evtx_structures(synthetic_mmap)) == \
+        list(evtxtract.carvers.find_evtx_structures(synthetic_mmap, jobs=4))
+    assert list(evtxtract.carvers.find_evtx_chunks(synthetic_mmap)) == \
+        list(evtxtract.carvers.find_evtx_chunks(synthetic_mmap, jobs=4))
+    assert list(evtxtract.carvers.find_evtx_records(synthetic_mmap)) == \
+        list(evtxtract.carvers.find_evtx_records(synthetic_mmap, jobs=4))
+
+
+def test_find_structures_parallel_unsupported(synthetic_mmap, monkeypatch):
+    # without `multiprocessing.get_context`, as on python 2.7, the scan falls back to a single process.
+    monkeypatch.delattr(evtxtract.carvers.multiprocessing, 'get_context')
+    assert list(evtxtract.carvers.find_evtx_structures(synthetic_mmap)) == \
+        list(evtxtract.carvers.find_evtx_structures(synthetic_mmap, jobs=4))
+
+
+def test_filter_records(synthetic_mmap):
+    # the batch validator must agree with validating one candidate at a time.
+    candidates = list(evtxtract.carvers.find_magic(synthetic_mmap, evtxtract.carvers.EVTX_RECORD_MAGIC))
+    expected = [offset for offset in candidates if evtxtract.carvers.is_record(synthetic_mmap, offset)]
+    assert expected == evtxtract.carvers.filter_records(synthetic_mmap, candidates)
+    assert len(candidates) > len(expected)
+
+
+@pytest.mark.parametrize('typecode', [evtxtract.utils.OFFSET_TYPECODE, None])
+def test_interval_index(monkeypatch, typecode):
+    # without a 64-bit array typecode, such as on python 2.7 on Windows, the offsets are kept in lists.
+    monkeypatch.setattr(evtxtract.utils, 'OFFSET_TYPECODE', typecode)
+    index = evtxtract.utils.IntervalIndex()
+    index.add(0x200, 0x400)
+    index.add(0x400, 0x800)
+    index.add(0x1000, 0x1100)
+    # adjacent intervals are merged
+    assert len(index) == 2
+
+    assert 0x1ff not in index
+    assert 0x200 in index
+    assert index.find(0x300) == 0x800
+    assert 0x800 not in index
+    assert list(index.gaps(0x0, 0x2000)) == [(0x0, 0x200), (0x800, 0x1000), (0x1100, 0x2000)]
+    assert list(index.gaps(0x300, 0x1080)) == [(0x800, 0x1000)]
+
+
+def test_extract_stream(synthetic_mmap):
+    # reading the image as a stream must recover the same records as scanning the mapping.
+    expected = summarize(evtxtract.extract(synthetic_mmap))
+    records = list(evtxtract.extract_stream(io.BytesIO(synthetic_mmap[:])))
+    assert expected == summarize(records)
+    assert count_records(records) == SYNTHETIC_COUNTS
+
+
+def test_extract_windowed(synthetic_image, synthetic_mmap):
+    # mapping the image a window at a time must recover the same records as mapping it whole.
+    expected = summarize(evtxtract.extract(synthetic_mmap))
+    with evtxtract.utils.WindowedMmap(synthetic_image, window_size=0x100000,
+                                      overlap=evtxtract.carvers.MAX_STRUCTURE_SIZE) as mm:
+        records = list(evtxtract.extract_windowed(mm))
+    assert expected == summarize(records)
+    assert count_records(records) == SYNTHETIC_COUNTS
+
+
+def test_extract_windowed_parallel(synthetic_image, monkeypatch):
+    # one pool scans the shards of all the windows, and must recover the same records as a serial scan.
+    monkeypatch.setattr(evtxtract.carvers, 'SCAN_BLOCK_SIZE', 0x40000)
+    monkeypatch.setattr(evtxtract.carvers, 'MIN_SHARD_SIZE', 0x40000)
+    with evtxtract.utils.WindowedMmap(synthetic_image, window_size=0x100000,
+                                      overlap=evtxtract.carvers.MAX_STRUCTURE_SIZE) as mm:
+        expected = summarize(evtxtract.extract_windowed(mm))
+
+        report = evtxtract.carvers.ScanReport()
+        with evtxtract.carvers.ScanPool(synthetic_image, jobs=4) as pool:
+            records = list(evtxtract.extract_windowed(mm, report=report, pool=pool))
+    assert expected == summarize(records)
+    assert count_records(records) == SYNTHETIC_COUNTS
+    assert report.uniform_bytes > 0
+
+
+def test_find_uniform_pages():
+    page = evtxtract.carvers.PAGE_SIZE
+    buf = bytearray(b'\x00' * page * 2 + b'\xff' * page + b'\x01' * page)
+    buf[page * 3 + 7] = 0x02
+    # a signature that crosses a page boundary leaves both pages non-uniform.
+    buf[page * 3 - 2:page * 3 + 2] = evtxtract.carvers.EVTX_RECORD_MAGIC
+    buf = bytes(buf)
+
+    assert evtxtract.carvers.find_uniform_pages(buf) == [(0x0, page * 2)]
+
+    report = evtxtract.carvers.ScanReport()
+    ranges = evtxtract.carvers.find_scan_ranges(buf, report=report)
+    assert ranges == [(page * 2 - evtxtract.carvers.SIGNATURE_SLACK, len(buf))]
+    assert report.uniform_bytes == page * 2 - evtxtract.carvers.SIGNATURE_SLACK
+
+
+def check_resume(path, tmpdir, stops, jobs=1):
+    # an extraction interrupted after a checkpoint and then resumed must emit each record exactly once.
+    def open_image():
+        return evtxtract.utils.WindowedMmap(path, window_size=0x100000, overlap=evtxtract.carvers.MAX_STRUCTURE_SIZE)
+
+    def format_record(r):
+        return ('0x%x %d\n' % (r.offset, r.eid)).encode('ascii')
+
+    with open_image() as mm:
+        expected = b''.join(format_record(r) for r in evtxtract.extract_windowed(mm))
+
+    for stop in stops:
+        state_path = str(tmpdir.join('state-%d' % (stop)))
+        output_path = str(tmpdir.join('output-%d' % (stop)))
+        with open(output_path, 'wb') as output:
+            with open_image() as mm:
+                checkpoint = evtxtract.checkpoint.Checkpoint(state_path, len(mm), output=output, interval=0)
+                for i, r in enumerate(evtxtract.extract_windowed(mm, jobs=jobs, checkpoint=checkpoint)):
+                    if i == stop:
+                        break
+                    output.write(format_record(r))
+
+        with open(output_path, 'ab') as output:
+            with open_image() as mm:
+                checkpoint = evtxtract.checkpoint.Checkpoint.load(state_path, len(mm), output=output, interval=0)
+                checkpoint.restore_output()
+                for r in evtxtract.extract_windowed(mm, jobs=jobs, checkpoint=checkpoint):
+                    output.write(format_record(r))
+
+        with open(output_path, 'rb') as output:
+            assert output.read() == expected
+
+    return expected.count(b'\n')
+
+
+def test_extract_resume(synthetic_image, tmpdir):
+    total = sum(SYNTHETIC_COUNTS)
+    assert check_resume(synthetic_image, tmpdir, [total // 2]) == total
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_extract_resume_partial_window(tmpdir, monkeypatch, jobs):
+    # the last window is partial, so resuming after the scan must not scan it again.
+    monkeypatch.setattr(evtxtract.carvers, 'SCAN_BLOCK_SIZE', 0x40000)
+    monkeypatch.setattr(evtxtract.carvers, 'MIN_SHARD_SIZE', 0x40000)
+    path = str(tmpdir.join('partial.img'))
+    with open(path, 'wb') as f:
+        f.write(make_synthetic_image() + make_chunk(19, [1, 2, 1, 2, 1, 1]) + b'\x00' * 0x3000)
+
+    total = sum(SYNTHETIC_COUNTS) + 6
+    assert check_resume(path, tmpdir, range(0, total, 3), jobs=jobs) == total
+
+
+def test_template_index():
+    def make_template(eid, placeholders):
+        return evtxtract.templates.Template(eid, ''.join(
+            '[%s Substitution(index=%d, type=%d)]' % ('Conditional' if is_conditional else 'Normal', index, type_)
+            for index, type_, is_conditional in placeholders))
+
+    sizetype = make_template(4624, [(0, 4, False), (1, 16, False), (2, 1, True)])
+    other = make_template(4624, [(0, 4, False), (1, 8, False)])
+    index = evtxtract.templates.TemplateIndex()
+    index.add(sizetype)
+    index.add(other)
+    index.add(make_template(4625, [(0, 4, False)]))
+    assert len(index) == 3
+
+    cases = [
+        [(4, 1), (16, 2), (1, 'a')],
+        # a Hex64 may be provided for a SizeType
+        [(4, 1), (21, 2), (1, 'a')],
+        # a conditional substitution may be empty
+        [(4, 1), (16, 2), (0, None)],
+        [(4, 1), (8, 2)],
+        [(4, 1), (0, None), (1, 'a')],
+        [(4, 1)],
+    ]
+    for substitutions in cases:
+        expected = set(t for t in index.get_templates(4624) if t.match_substitutions(substitutions))
+        assert expected == set(index.match(4624, substitutions))
+
+    assert index.match(4624, cases[1]) == [sizetype]
+    assert index.match(4624, cases[3]) == [other]
+    assert index.match(4624, cases[4]) == []
+    assert index.match(1, cases[0]) == []
+
+
+def test_insert_substitutions():
+    template = evtxtract.templates.Template(1, '<Data>[Normal Substitution(index=0, type=1)]</Data>'
+                                               '<Data>[Conditional Substitution(index=1, type=8)]</Data>'
+                                               '<Data>[Normal Substitution(index=0, type=1)]</Data>'
+                                               '<Data>[Normal Substitution(index=2, type=1)]</Data>')
+    # values are inserted verbatim, and placeholders without a substitution are left as-is.
+    assert template.insert_substitutions([(1, 'C:\\Windows\\1'), (8, 1204)]) == (
+        '<Data>C:\\Windows\\1</Data><Data>1204</Data><Data>C:\\Windows\\1</Data>'
+        '<Data>[Normal Substitution(index=2, type=1)]</Data>')
+
+
+def test_template_library(tmpdir):
+    first = evtxtract.templates.Template(1, '<EventID>[Normal Substitution(index=3, type=6)]</EventID>')
+    second = evtxtract.templates.Template(2, '<Data>[Normal Substitution(index=0, type=1)]</Data>')
+    # the same id as the first template, so it's not added.
+    duplicate = evtxtract.templates.Template(1, '<Id>[Normal Substitution(index=3, type=6)]</Id>')
+
+    path = str(tmpdir.join('a.db'))
+    with evtxtract.library.TemplateLibrary(path) as library:
+        assert library.add([first, duplicate]) == 1
+
+    other_path = str(tmpdir.join('b.db'))
+    with evtxtract.library.TemplateLibrary(other_path) as library:
+        assert library.add([second]) == 1
+        assert library.merge(path) == 1
+
+    index = evtxtract.templates.TemplateIndex()
+    with evtxtract.library.TemplateLibrary(other_path) as library:
+        assert library.load(index) == 2
+
+    assert set((t.get_id(), t.xml) for t in index) == set((t.get_id(), t.xml) for t in (first, second))
+
+
+def test_find_evtx_files(tmpdir):
+    tmpdir.join('a.evtx').write('')
+    tmpdir.join('notes.txt').write('')
+    tmpdir.mkdir('sub').join('B.EVTX').write('')
+
+    found = list(evtxtract.library.find_evtx_files([str(tmpdir)]))
+    assert found == [str(tmpdir.join('a.evtx')), str(tmpdir.join('sub', 'B.EVTX'))]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_harvest(tmpdir, jobs):
+    paths = [str(tmpdir.join(name)) for name in ('a.evtx', 'b.evtx', 'c.evtx')]
+    with open(paths[0], 'wb') as f:
+        f.write(make_evtx([make_chunk(1, [1, 2, 1])]))
+    with open(paths[1], 'wb') as f:
+        # the templates of a corrupted chunk aren't harvested.
+        f.write(make_evtx([make_chunk(1, [2, 3]), make_chunk(3, [9], corrupt=True)]))
+    with open(paths[2], 'wb') as f:
+        f.write(b'not an evtx file')
+
+    harvested = evtxtract.library.harvest_file(paths[1])
+    assert sorted(eid for _, eid, _ in harvested) == [2, 3]
+    assert all(template_id.startswith('%d-' % (eid)) for template_id, eid, _ in harvested)
+    assert evtxtract.library.harvest_file(paths[2]) == []
+
+    # the templates are unique across the files.
+    templates = list(evtxtract.library.harvest(paths, jobs=jobs))
+    assert sorted(template.eid for template in templates) == [1, 2, 3]
+    assert len(set(template.get_id() for template in templates)) == 3
+    assert all('[6|8|' in template.get_id() for template in templates)
+
+
+def test_lru_cache():
+    cache = evtxtract.utils.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # 'b' is now the least recently used entry
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_get_eid():
+    ns = 'xmlns="http://schemas.microsoft.com/win/2004/08/events/event"'
+    assert evtxtract.utils.get_eid('<Event %s><System><EventID Qualifiers="">823</EventID></System>'
+                                   '<UserData><EventID>1</EventID></UserData></Event>' % ns) == 823
+    # falls back to parsing the XML, which resolves the character reference.
+    assert evtxtract.utils.get_eid('<Event %s><System><EventID>&#52;</EventID></System></Event>' % ns) == 4
+
+
+def test_substitution_decoders():
+    decoders = evtxtract.carvers.SUBSTITUTION_DECODERS
+    guid = b'\x03\x02\x01\x00\x05\x04\x07\x06\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f'
+    assert decoders[0xF](b'\xff' + guid, 1, 16) == '00010203-0405-0607-0809-0a0b0c0d0e0f'
+    systemtime = struct.pack('<8H', 2013, 3, 6, 23, 2, 5, 57, 123)
+    assert decoders[0x12](systemtime, 0, 16) == datetime.datetime(2013, 3, 23, 2, 5, 57, 123000)
+    assert decoders[0xE](b'\x01\xab', 0, 2) == '01ab'
+    assert decoders[0x14](b'\xef\xbe\xad\xde', 0, 4) == '0xdeadbeef'
+    sid = struct.pack('<BB', 1, 2) + struct.pack('>IH', 0, 5) + struct.pack('<II', 21, 1000)
+    assert decoders[0x13](sid, 0, len(sid)) == 'S-1-5-21-1000'
+
+
+def test_lazy_substitutions():
+    values = [(0x8, struct.pack('<I', 1204)), (0x2, b'\xff\xfe'), (0x1, u'A&B'.encode('utf-16le'))]
+    buf = b'\x0f\x01\x01\x00' + struct.pack('<BBIII', 0x0C, 0x01, 0, 0, len(values))
+    buf += b''.join(struct.pack('<HBx', len(value), type_) for type_, value in values)
+    buf += b''.join(value for _, value in values)
+
+    substitutions = evtxtract.carvers.extract_root_substitutions(buf, 0, len(buf))
+    assert len(substitutions) == 3
+    assert [s[0] for s in substitutions] == [0x8, 0x2, 0x1]
+    assert substitutions[0][1] == 1204
+    type_, value = substitutions[-1]
+    assert (type_, value) == (0x1, 'A&amp;B')
+    # the invalid string is only decoded when its value is accessed.
+    with pytest.raises(evtxtract.carvers.ParseError):
+        substitutions[1][1]
+
+    # so a record with the invalid string fails when it's written, and the writers report it wasn't.
+    record = evtxtract.IncompleteRecord(0x2000, 4625, substitutions)
+    valid = evtxtract.IncompleteRecord(0x3000, 4625, [(0x8, 1204)])
+    for writer in (evtxtract.output.XmlWriter(io.BytesIO()), evtxtract.output.JsonLinesWriter(io.BytesIO())):
+        with writer:
+            assert not writer.write(record)
+            assert writer.write(valid)
+
+
+def test_decode_wstring_array():
+    decode = evtxtract.carvers.SUBSTITUTION_DECODERS[0x81]
+
+    def encode(strings):
+        return b''.join(s.encode('utf-16le') + b'\x00\x00' for s in strings)
+
+    data = encode([u'a<b', u'', u'\u0100\u0a41'])
+    assert decode(data, 0, len(data)) == [u'a&lt;b', u'', u'\u0100\u0a41']
+    data = encode([u'', u'a'])
+    assert decode(data, 0, len(data)) == [u'', u'a']
+    # the final string may not be terminated
+    assert decode(data[:-2], 0, len(data) - 2) == [u'', u'a']
+    with pytest.raises(evtxtract.carvers.ParseError):
+        decode(data, 0, len(data) - 1)
+
+
+def test_xml_writer():
+    records = [
+        evtxtract.CompleteRecord(0x1000, 4624, u'<Event>\xe9</Event>'),
+        evtxtract.IncompleteRecord(0x2000, 4625, [(0x8, 1204), (0x0, None)]),
+    ]
+
+    out = io.BytesIO()
+    with evtxtract.output.XmlWriter(out, buffer_size=0x10) as writer:
+        for record in records:
+            writer.write(record)
+    doc = out.getvalue().decode('utf-8')
+    assert doc.startswith(evtxtract.output.XML_HEADER + u'<Event>\xe9</Event><Record>')
+    assert doc.endswith(u'</Record>' + evtxtract.output.XML_FOOTER)
+    assert len(lxml.etree.fromstring(out.getvalue())) == 2
+
+    # nothing is written until the buffer fills or is flushed.
+    out = io.BytesIO()
+    writer = evtxtract.output.XmlWriter(out, header=False)
+    writer.write(records[0])
+    assert out.getvalue() == b''
+    writer.flush()
+    assert out.getvalue() == u'<Event>\xe9</Event>'.encode('utf-8')
+
+
+def test_json_lines_writer():
+    ns = 'xmlns="http://schemas.microsoft.com/win/2004/08/events/event"'
+    template = evtxtract.templates.Template(4624, (
+        '<Event %s><System><EventID>[Normal Substitution(index=0, type=6)]</EventID>'
+        '<TimeCreated SystemTime="[Normal Substitution(index=1, type=17)]"></TimeCreated></System>'
+        '<EventData><Data Name="TargetUserName">[Normal Substitution(index=2, type=1)]</Data>'
+        '<Data Name="LogonType">type [Normal Substitution(index=3, type=8)]</Data></EventData></Event>') % ns)
+    substitutions = [(6, 4624), (17, datetime.datetime(2013, 3, 23, 2, 5, 57)), (1, 'a&amp;b'), (8, 2)]
+    records = [
+        evtxtract.CompleteRecord(0x1000, 4624, template=template, substitutions=substitutions),
+        evtxtract.CompleteRecord(0x2000, 4624, xml=template.insert_substitutions(substitutions)),
+        evtxtract.IncompleteRecord(0x3000, 4625, substitutions),
+    ]
+
+    out = io.BytesIO()
+    with evtxtract.output.JsonLinesWriter(out) as writer:
+        for record in records:
+            writer.write(record)
+    carved, chunked, incomplete = [json.loads(line) for line in out.getvalue().decode('utf-8').splitlines()]
+
+    assert carved['offset'] == 0x1000
+    assert carved['complete'] is True
+    assert carved['event'] == {
+        'System': {'EventID': 4624, 'TimeCreated': {'#attributes': {'SystemTime': '2013-03-23T02:05:57'}}},
+        'EventData': {'TargetUserName': 'a&b', 'LogonType': 'type 2'},
+    }
+    # records recovered from intact chunks have the same fields, as text.
+    assert chunked['event']['EventData'] == carved['event']['EventData']
+    assert chunked['event']['System']['EventID'] == '4624'
+
+    assert incomplete['complete'] is False
+    assert incomplete['substitutions'][2] == {'type': 1, 'value': 'a&b'}
+
+
+def test_json_lines_writer_unescaped_template():
+    # the literal text of template views isn't escaped, so it may not be well-formed.
+    template = evtxtract.templates.Template(4624, (
+        '<Event><System><Provider Name="A&B"></Provider></System>'
+        '<EventData><Data>[Normal Substitution(index=0, type=1)] < 5 & &amp; more</Data></EventData></Event>'))
+    record = evtxtract.CompleteRecord(0x1000, 4624, template=template, substitutions=[(1, 'a&amp;b')])
+
+    out = io.BytesIO()
+    with evtxtract.output.JsonLinesWriter(out) as writer:
+        assert writer.write(record)
+    event = json.loads(out.getvalue().decode('utf-8'))['event']
+    assert event['System'] == {'Provider': {'#attributes': {'Name': 'A&B'}}}
+    assert event['EventData'] == {'Data': 'a&b < 5 & & more'}
+
+
+def test_sqlite_writer(tmpdir):
+    path = str(tmpdir.join('records.db'))
+    substitutions = [(6, 4625), (17, datetime.datetime(2013, 3, 23, 2, 5, 57)), (1, 'a&amp;b'),
+                     (0xA, 0xFFFFFFFFFFFFFFFF), (0x81, ['c', ''])]
+    records = [
+        evtxtract.CompleteRecord(0x1000, 4624, u'<Event></Event>', num=7, chunk_offset=0x800),
+        evtxtract.IncompleteRecord(0x3000, 4625, substitutions, num=8,
+                                   timestamp=datetime.datetime(2013, 3, 23, 2, 5, 58)),
+    ]
+    with evtxtract.output.SqliteWriter(path, batch_size=1) as writer:
+        for record in records:
+            writer.write(record)
+    # records written again, such as after resuming, replace the existing rows.
+    with evtxtract.output.SqliteWriter(path) as writer:
+        writer.write(records[1])
+
+    db = sqlite3.connect(path)
+    assert db.execute('SELECT * FROM records ORDER BY record_offset').fetchall() == [
+        (0x1000, 0x800, 1, 4624, 7, None, u'<Event></Event>'),
+        (0x3000, None, 0, 4625, 8, u'2013-03-23 02:05:58', None),
+    ]
+    assert db.execute('SELECT type, value FROM substitutions WHERE record_offset = ? ORDER BY position',
+                      (0x3000, )).fetchall() == [
+        (6, 4625), (17, u'2013-03-23 02:05:57'), (1, u'a&b'), (0xA, u'18446744073709551615'), (0x81, u'["c", ""]'),
+    ]
+    db.close()
+
+
+def test_split_writer(tmpdir):
+    records = [
+        evtxtract.CompleteRecord(0x1000, 4624, u'<Event>\xe9</Event>'),
+        evtxtract.IncompleteRecord(0x2000, 4625, [(0x8, 1204), (0x0, None)]),
+    ]
+    with evtxtract.output.SplitWriter(str(tmpdir), threads=2) as writer:
+        for record in records:
+            writer.write(record)
+
+    complete = evtxtract.output.SplitWriter.get_path(records[0])
+    incomplete = evtxtract.output.SplitWriter.get_path(records[1])
+    assert complete.endswith('4624-4096.xml')
+    assert incomplete.endswith('4625-8192-incomplete.xml')
+    # files are sharded into subdirectories.
+    assert len(complete.split(os.sep)) == evtxtract.output.SPLIT_SHARD_LEVELS + 1
+
+    doc = tmpdir.join(complete).read_binary()
+    assert doc == (evtxtract.output.XML_HEADER + u'<Event>\xe9</Event>' + evtxtract.output.XML_FOOTER).encode('utf-8')
+    assert lxml.etree.fromstring(tmpdir.join(incomplete).read_binary())[0].tag == 'Record'
+
+
+def test_compressed_stream():
+    records = [evtxtract.CompleteRecord(0x1000 * i, 4624, u'<Event>%d\xe9</Event>' % (i)) for i in range(100)]
+
+    out = io.BytesIO()
+    with evtxtract.output.XmlWriter(out, buffer_size=0x100) as writer:
+        for record in records:
+            writer.write(record)
+    expected = out.getvalue()
+
+    decompressors = {'gzip': lambda data: gzip.GzipFile(fileobj=io.BytesIO(data)).read(), 'bz2': bz2.decompress}
+    if evtxtract.utils.lzma is not None:
+        decompressors['xz'] = evtxtract.utils.lzma.decompress
+
+    for compression, decompress in decompressors.items():
+        out = io.BytesIO()
+        stream = evtxtract.output.CompressedStream(out, compression, threads=2)
+        threads = list(stream._threads)
+        with evtxtract.output.XmlWriter(stream, buffer_size=0x100, close_stream=True) as writer:
+            for i, record in enumerate(records):
+                writer.write(record)
+                if i == 50:
+                    writer.flush()
+                    # a flush completes the compressed data written so far.
+                    assert decompress(out.getvalue()) == expected[:len(decompress(out.getvalue()))]
+        # the blocks are compressed separately, and concatenated.
+        assert decompress(out.getvalue()) == expected
+        # closing the writer stops the threads, but leaves the underlying stream open.
+        assert not any(thread.is_alive() for thread in threads)
+        assert not out.closed
+
+
+def test_duplicate_filter():
+    digests = [hashlib.md5(struct.pack('<I', i)).digest() for i in range(1000)]
+
+    bloom = evtxtract.utils.BloomFilter(100)
+    assert [bloom.add(digest) for digest in digests[:10]] == [False] * 10
+    assert all(bloom.add(digest) for digest in digests[:10])
+
+    # the Bloom filter is overfilled, so it has false positives, which must not suppress records.
+    report = evtxtract.carvers.ScanReport()
+    duplicates = evtxtract.DuplicateFilter(report, capacity=100)
+    assert not any(duplicates.is_duplicate(digest) for digest in digests)
+    assert all(duplicates.is_duplicate(digest) for digest in digests)
+    assert report.duplicate_records == len(digests)
+
+
+def test_extract_dedup(synthetic_mmap):
+    report = evtxtract.carvers.ScanReport()
+    expected = summarize(evtxtract.extract(synthetic_mmap, report=report, dedup=True))
+    assert len(expected) == sum(SYNTHETIC_COUNTS) - SYNTHETIC_DUPLICATE_RECORDS
+    assert report.duplicate_records == SYNTHETIC_DUPLICATE_RECORDS
+
+    # each record of a copied image is a copy of a record in the original.
+    report = evtxtract.carvers.ScanReport()
+    records = list(evtxtract.extract(synthetic_mmap[:] + synthetic_mmap[:], report=report, dedup=True))
+    assert summarize(records) == expected
+    assert report.duplicate_records == sum(SYNTHETIC_COUNTS) + SYNTHETIC_DUPLICATE_RECORDS
+
+
+def test_is_chunk_header():
+    chunk = make_chunk(1, [1, 2, 1])
+    buf = b'\x00' * 0x1000 + chunk
+    assert evtxtract.carvers.is_chunk_header(buf, 0x1000)
+    assert not evtxtract.carvers.is_chunk_header(buf, 0)
+
+    # corrupt the header, which is covered by the header checksum.
+    corrupt = bytearray(buf)
+    corrupt[0x1010] ^= 0xFF
+    assert not evtxtract.carvers.is_chunk_header(bytes(corrupt), 0x1000)
+
+    # corrupt a record, which is covered by the data checksum.
+    corrupt = bytearray(buf)
+    corrupt[0x1000 + 0x220] ^= 0xFF
+    assert not evtxtract.carvers.is_chunk_header(bytes(corrupt), 0x1000)
+
+    # the chunk must fit in the buffer.
+    assert not evtxtract.carvers.is_chunk_header(buf[:-1], 0x1000)
+
+
+def test_is_chunk_header_mmap(tmpdir):
+    # memory maps are checksummed in place on python 3, and by slices on python 2.
+    path = tmpdir.join('chunk.bin')
+    path.write_binary(make_chunk(1, [1, 2, 1]))
+    with evtxtract.utils.Mmap(str(path)) as mm:
+        assert evtxtract.carvers.is_chunk_header(mm, 0)